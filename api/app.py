@@ -1,13 +1,43 @@
 import os
+import re
+import sys
+import json
+import time
+import queue
+import signal
+import atexit
 import logging
+import threading
+import click
+from contextlib import contextmanager
 import pymongo
-from flask import Flask, request, abort, jsonify
+from flask import Flask, request, abort, jsonify, g, Response, stream_with_context
 from flask_pymongo import PyMongo
-from flask_jwt_extended import JWTManager, jwt_required, create_access_token, get_jwt_identity
+from flask_jwt_extended import JWTManager, jwt_required, create_access_token, get_jwt_identity, verify_jwt_in_request
 from bson import json_util, ObjectId
 from dotenv import load_dotenv
 from pymongo import ReturnDocument
-from datetime import datetime
+from datetime import datetime, timedelta
+from werkzeug.exceptions import HTTPException
+from werkzeug.middleware.proxy_fix import ProxyFix
+from ratelimit import RateLimiter, AdmissionController
+from idempotency import IdempotencyStore
+from changefeed import ChangeHub
+from stockshards import ShardedStock
+from writebehind import WriteBehindBuffer, BufferFull
+from validation import (ObjectIdConverter, Schema, String, Number, Integer, List, DateTimeString,
+                        ObjectIdString, validate_json)
+from archive import ARCHIVES, archive_collection, read_archive
+from rollups import FOLD, ROLLUP_INDEXES, SOURCES, exclusive, fold_sales, folded, seller_sales, rebuild
+from listings import seller_listings
+from capture import TrafficCapture
+from batch import BATCH_ENVIRON_KEY, BatchError, BatchRunner
+from profiling import SlowQueryListener, start_timer, add_server_timing
+from resilience import DatabaseGuard, CircuitBreaker, CircuitOpen, UNAVAILABLE as DB_UNAVAILABLE
+from catalog import CATALOG_INDEXES, CatalogQueryError, build_catalog_query, is_filtered
+from changes import HIDDEN, LIVE, SYNC_INDEX, SyncTokenError, changes_since, created, latest_change, tombstone, touch
+from snapshot import CatalogSnapshot
+from migrations import MIGRATIONS, MIGRATIONS_COLLECTION, StorageFormat, match_ref, match_time, migrate, to_api
 
 # load env
 load_dotenv()
@@ -18,11 +48,306 @@ logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 app.config['MONGO_URI'] = os.getenv('MONGO_URI')
-mongo = PyMongo(app)
+
+# Mongo commands slower than SLOW_QUERY_MS are kept, with their explain plans,
+# for /api/admin/slow_queries
+slow_queries = SlowQueryListener(lambda: mongo.cx, threshold_ms=float(os.getenv('SLOW_QUERY_MS', 100)))
+# Each database call a request makes is bounded by DB_CALL_DEADLINE seconds:
+# socket reads time out after it (unless MONGO_URI sets socketTimeoutMS), and
+# retries stop once it has passed. Server selection keeps the URI's own
+# serverSelectionTimeoutMS. Maintenance commands use maintenance_db() instead,
+# whose long operations must not be cut off.
+DB_CALL_DEADLINE = float(os.getenv('DB_CALL_DEADLINE', 3))
+client_options = {'event_listeners': [slow_queries]}
+if 'sockettimeoutms=' not in (app.config['MONGO_URI'] or '').lower():
+    client_options['socketTimeoutMS'] = int(DB_CALL_DEADLINE * 1000)
+mongo = PyMongo(app, **client_options)
+
+
+def maintenance_db():
+    return pymongo.MongoClient(app.config['MONGO_URI']).get_default_database()
+
+# Usernames allowed to use the /api/admin endpoints
+ADMIN_USERS = {user for user in os.getenv('ADMIN_USERS', '').split(',') if user}
+
+# Adds a Server-Timing header splitting each response's time into database,
+# serialization and handler time
+if os.getenv('SERVER_TIMING', '').lower() in ('1', 'true', 'yes'):
+    app.before_request(start_timer)
+    app.after_request(add_server_timing)
+
+# Opt-in capture of sanitized request shapes to CAPTURE_FILE, for replay.py.
+# CAPTURE_SECRET keys the pseudonyms JWT subjects are recorded under
+if os.getenv('CAPTURE_FILE'):
+    traffic_capture = TrafficCapture(os.getenv('CAPTURE_FILE'), lambda: current_subject(),
+                                     secret=os.getenv('CAPTURE_SECRET'))
+    app.before_request(traffic_capture.start)
+    app.after_request(traffic_capture.record)
+    atexit.register(traffic_capture.close)
 
 app.config['JWT_SECRET_KEY'] = os.getenv('JWT_SECRET_KEY')
 jwt = JWTManager(app)
 
+# Request bodies are capped, and every write body and id parameter is checked
+# before a view touches the database
+app.config['MAX_CONTENT_LENGTH'] = int(os.getenv('MAX_CONTENT_LENGTH', 64 * 1024))
+app.url_map.converters['objectid'] = ObjectIdConverter
+
+# Number of reverse proxies in front of the app (e.g. Azure's front end), so
+# rate limits key on the real client address rather than the proxy's
+if int(os.getenv('TRUSTED_PROXIES', 0)):
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=int(os.getenv('TRUSTED_PROXIES')))
+
+# Rate limits per endpoint as (requests per second, burst), applied per caller.
+# Callers are identified by JWT subject when a valid token is sent, else by IP,
+# which behind a proxy is only the client's if TRUSTED_PROXIES counts it (the
+# production image sets 1 for Azure's front end).
+# None disables limiting for an endpoint.
+RATE_LIMITS = {
+    'healthcheck': None,
+    'login': (0.2, 5),
+    'register': (0.1, 3),
+    'check_username': (2, 10),
+    'search_products': (2, 10),
+}
+DEFAULT_RATE_LIMIT = (10, 30)
+rate_limiter = RateLimiter(RATE_LIMITS, DEFAULT_RATE_LIMIT)
+
+# Requests beyond MAX_IN_FLIGHT wait up to QUEUE_TIMEOUT seconds for a slot,
+# with at most MAX_QUEUED waiting; anything more is shed with a 503.
+# Keep MAX_IN_FLIGHT + MAX_QUEUED + MAX_STREAMS within waitress' --threads.
+admission = AdmissionController(
+    max_in_flight=int(os.getenv('MAX_IN_FLIGHT', 16)),
+    max_queued=int(os.getenv('MAX_QUEUED', 16)),
+    queue_timeout=float(os.getenv('QUEUE_TIMEOUT', 0.5)))
+ADMISSION_EXEMPT = {'healthcheck', 'stream_updates'}
+
+
+def current_subject():
+    # The JWT subject if a valid token was sent, without requiring one
+    try:
+        verify_jwt_in_request(optional=True)
+        return get_jwt_identity()
+    except Exception:
+        return None
+
+
+def get_client_identity():
+    identity = current_subject()
+    return f"user:{identity}" if identity else f"ip:{request.remote_addr}"
+
+
+@app.before_request
+def apply_rate_limit():
+    if request.endpoint is None:
+        return
+
+    allowed, retry_after = rate_limiter.hit(request.endpoint, get_client_identity())
+    if not allowed:
+        response = jsonify({"msg": "Too many requests"})
+        response.headers['Retry-After'] = str(max(1, round(retry_after)))
+        return response, 429
+
+
+@app.before_request
+def admit_request():
+    # Batched sub-requests run inside a batch that already holds a slot
+    if request.endpoint in ADMISSION_EXEMPT or request.environ.get(BATCH_ENVIRON_KEY):
+        return
+
+    if not admission.acquire():
+        logger.warning(f"Shedding request: {request.method} {request.path}")
+        response = jsonify({"msg": "Server overloaded, please retry"})
+        response.headers['Retry-After'] = '1'
+        return response, 503
+    g.admitted = True
+
+
+@app.teardown_request
+def release_admission(exc):
+    if g.pop('admitted', False):
+        admission.release()
+
+
+# How long a stored response can be replayed for a given Idempotency-Key
+IDEMPOTENCY_TTL = int(os.getenv('IDEMPOTENCY_TTL', 24 * 60 * 60))
+idempotency = IdempotencyStore(lambda: mongo.db.idempotency_keys,
+                               run=lambda call, retry=True: handle_db_call(call, retry=retry))
+
+# Hot products can spread their stock over up to MAX_STOCK_SHARDS documents;
+# shard totals are cached for STOCK_CACHE_TTL seconds
+MAX_STOCK_SHARDS = 64
+sharded_stock = ShardedStock(lambda: mongo.db, cache_ttl=float(os.getenv('STOCK_CACHE_TTL', 1)))
+
+# Reservations hold stock for RESERVATION_TTL seconds; closed ones are purged
+# after RESERVATION_RETENTION seconds
+RESERVATION_TTL = int(os.getenv('RESERVATION_TTL', 10 * 60))
+RESERVATION_RETENTION = int(os.getenv('RESERVATION_RETENTION', 24 * 60 * 60))
+RESERVATION_SWEEP_INTERVAL = int(os.getenv('RESERVATION_SWEEP_INTERVAL', 15))
+RESERVATION_MAX_UNITS = 10
+
+# Purchase and booking records can be group-committed in the background
+# instead of inserted on the request path
+write_behind = None
+if os.getenv('WRITE_BEHIND', '').lower() in ('1', 'true', 'yes'):
+    write_behind = WriteBehindBuffer(
+        lambda: mongo.db,
+        max_batch=int(os.getenv('WRITE_BEHIND_MAX_BATCH', 100)),
+        flush_interval=float(os.getenv('WRITE_BEHIND_FLUSH_INTERVAL', 0.2)),
+        max_pending=int(os.getenv('WRITE_BEHIND_MAX_PENDING', 10000)))
+    atexit.register(write_behind.close)
+    # Turn SIGTERM into a normal exit so the buffer is flushed on shutdown
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+CREDENTIALS_SCHEMA = Schema('account', {
+    'username': (String(max_length=64), True),
+    'password': (String(max_length=128, strip=False), True),
+})
+PRODUCT_SCHEMA = Schema('product listing', {
+    'user': (String(max_length=64), True),
+    'description': (String(max_length=2000), True),
+    'price': (Number(positive=True, maximum=1_000_000), True),
+    'quantity': (Integer(minimum=1, maximum=100_000), True),
+})
+SERVICE_SCHEMA = Schema('service listing', {
+    'user': (String(max_length=64), True),
+    'description': (String(max_length=2000), True),
+    'price': (Number(positive=True, maximum=1_000_000), True),
+    'available_dates': (List(DateTimeString(), max_items=366, unique=True), True),
+})
+APPOINTMENT_SCHEMA = Schema('appointment', {
+    'user': (String(max_length=64), True),
+    'service_id': (ObjectIdString(), True),
+    'timeslot': (DateTimeString(), True),
+})
+RESERVATION_SCHEMA = Schema('reservation', {
+    'quantity': (Integer(minimum=1, maximum=RESERVATION_MAX_UNITS), False),
+}, defaults={'quantity': 1})
+SHARD_STOCK_SCHEMA = Schema('stock sharding', {
+    'shards': (Integer(minimum=2, maximum=MAX_STOCK_SHARDS), True),
+})
+
+# References and timestamps used to be stored as strings. Reads accept both
+# forms; turn NATIVE_TYPES on once every instance runs this version, so new
+# writes use ObjectIds and datetimes, then run `flask migrate`
+storage = StorageFormat(native=os.getenv('NATIVE_TYPES', '').lower() in ('1', 'true', 'yes'))
+
+# Deleted products and services are kept as tombstones for this long, so
+# clients syncing through /changes learn about the deletion; a sync token
+# older than this is refused. Changes newer than CHANGES_SETTLE_SECONDS are
+# held back in case a write with an earlier timestamp is still committing
+TOMBSTONE_RETENTION = int(os.getenv('TOMBSTONE_RETENTION', 30 * 24 * 3600))
+CHANGES_SETTLE_SECONDS = float(os.getenv('CHANGES_SETTLE_SECONDS', 5))
+CHANGES_MAX_LIMIT = 500
+LISTINGS_MAX_LIMIT = 100
+
+# History older than this is moved to archive collections by `flask archive`
+ARCHIVE_AFTER_DAYS = int(os.getenv('ARCHIVE_AFTER_DAYS', 365))
+
+# Every SALES_ROLLUP_INTERVAL seconds, the purchases and bookings stored since
+# the last fold are folded into the seller sales rollups
+SALES_ROLLUP_INTERVAL = float(os.getenv('SALES_ROLLUP_INTERVAL', 5))
+
+# Database calls fail fast for DB_CIRCUIT_RESET seconds after
+# DB_CIRCUIT_FAILURES consecutive connection failures
+db_guard = DatabaseGuard(
+    CircuitBreaker(failure_threshold=int(os.getenv('DB_CIRCUIT_FAILURES', 5)),
+                   reset_timeout=float(os.getenv('DB_CIRCUIT_RESET', 10))),
+    deadline=DB_CALL_DEADLINE)
+
+# (collection, keys, options) for every index the app relies on
+INDEXES = [
+    ('idempotency_keys', [('created_at', pymongo.ASCENDING)], {'expireAfterSeconds': IDEMPOTENCY_TTL}),
+    *[(collection, keys, {}) for collection in ('products', 'services')
+      for keys in CATALOG_INDEXES.values() if keys != [('_id', pymongo.ASCENDING)]],
+    ('product_stock_shards', [('product_id', pymongo.ASCENDING), ('shard', pymongo.ASCENDING)], {'unique': True}),
+    ('purchases', [('user', pymongo.ASCENDING)], {}),
+    ('purchases', [('purchase_time', pymongo.ASCENDING)], {}),
+    ('bookings', [('user', pymongo.ASCENDING)], {}),
+    ('bookings', [('booking_time', pymongo.ASCENDING)], {}),
+    ('appointments', [('timeslot', pymongo.ASCENDING)], {}),
+    ('appointments', [('service_id', pymongo.ASCENDING), ('timeslot', pymongo.ASCENDING)], {}),
+    *[(collection, [(FOLD, pymongo.ASCENDING)], {}) for collection in SOURCES],
+    *[(collection, keys, {}) for collection, keys in ROLLUP_INDEXES.items()],
+    *[(archive, [('user', pymongo.ASCENDING), ('month', pymongo.DESCENDING)], {})
+      for _, archive in ARCHIVES.values()],
+    *[(archive, [('ids', pymongo.ASCENDING)], {}) for _, archive in ARCHIVES.values()],
+    ('reservations', [('status', pymongo.ASCENDING), ('expires_at', pymongo.ASCENDING)], {}),
+    ('reservations', [('closed_at', pymongo.ASCENDING)], {'expireAfterSeconds': RESERVATION_RETENTION}),
+    *[(collection, SYNC_INDEX, {}) for collection in ('products', 'services')],
+    *[(collection, [('deleted_at', pymongo.ASCENDING)], {'expireAfterSeconds': TOMBSTONE_RETENTION})
+      for collection in ('products', 'services')],
+]
+INDEX_RETRY_INTERVAL = 30
+INDEX_OPTIONS_CONFLICT = 85
+_indexes_lock = threading.Lock()
+_indexes_ready = False
+_indexes_created = set()
+_indexes_attempted_at = None
+
+
+# POST /api/batch runs up to BATCH_MAX_REQUESTS calls, at most
+# BATCH_MAX_WRITES of them writes, with reads spread over BATCH_WORKERS
+# threads. Calls not started within BATCH_DEADLINE seconds are answered 503
+batch_runner = BatchRunner(
+    app,
+    max_requests=int(os.getenv('BATCH_MAX_REQUESTS', 20)),
+    max_writes=int(os.getenv('BATCH_MAX_WRITES', 5)),
+    workers=int(os.getenv('BATCH_WORKERS', 4)),
+    deadline=float(os.getenv('BATCH_DEADLINE', 10)),
+    forbidden={'batch_requests', 'stream_updates'})
+
+# Server-sent update streams each hold a waitress thread, so they are capped
+# and closed after STREAM_MAX_SECONDS (EventSource clients reconnect)
+change_hub = ChangeHub(lambda: mongo.db, max_subscribers=int(os.getenv('MAX_STREAMS', 8)))
+STREAM_MAX_SECONDS = int(os.getenv('STREAM_MAX_SECONDS', 300))
+STREAM_HEARTBEAT_SECONDS = 15
+STREAM_MAX_IDS = 50
+
+
+@app.before_request
+def ensure_indexes():
+    # Indexes are created on the first request that reaches the database, so
+    # the app can start before mongo is up
+    global _indexes_ready, _indexes_attempted_at
+    if _indexes_ready:
+        return
+    if _indexes_attempted_at and time.monotonic() - _indexes_attempted_at < INDEX_RETRY_INTERVAL:
+        return
+    if not _indexes_lock.acquire(blocking=False):
+        return
+
+    try:
+        _indexes_attempted_at = time.monotonic()
+        # One index failing doesn't hold up the others; only losing the
+        # connection stops the attempt
+        for index, (collection, keys, options) in enumerate(INDEXES):
+            if index in _indexes_created:
+                continue
+            try:
+                create_index(collection, keys, options)
+                _indexes_created.add(index)
+            except pymongo.errors.OperationFailure as e:
+                logger.warning(f"Failed to create index {keys} on {collection}, will retry: {e}")
+        _indexes_ready = len(_indexes_created) == len(INDEXES)
+    except pymongo.errors.PyMongoError as e:
+        logger.warning(f"Failed to create indexes, will retry: {e}")
+    finally:
+        _indexes_lock.release()
+
+
+def create_index(collection, keys, options):
+    try:
+        mongo.db[collection].create_index(keys, **options)
+    except pymongo.errors.OperationFailure as e:
+        # A TTL changed since the index was built; collMod updates it in place
+        if e.code != INDEX_OPTIONS_CONFLICT or 'expireAfterSeconds' not in options:
+            raise
+        mongo.db.command('collMod', collection,
+                         index={'keyPattern': dict(keys), 'expireAfterSeconds': options['expireAfterSeconds']})
+        logger.info(f"Changed the TTL of {keys} on {collection} to {options['expireAfterSeconds']}s")
+
 
 @app.before_request
 def log_request_info():
@@ -30,12 +355,37 @@ def log_request_info():
         f"Request: {request.method} {request.url} - Data: {request.json}")
 
 
-def handle_db_call(call):
+def dumps(data):
+    started = time.perf_counter()
+    serialized = json_util.dumps(data)
+    g.serialize_time = g.get('serialize_time', 0) + (time.perf_counter() - started) * 1000
+    return serialized
+
+
+def handle_db_call(call, retry=True):
+    """Runs every database call a route makes. Pass retry=False for writes
+    that are unsafe to repeat if the first attempt's outcome is unknown."""
+    with database_errors():
+        return db_guard.call(call, retry=retry)
+
+
+@contextmanager
+def database_errors():
+    # Turns an unavailable database into a 503 the client can retry
     try:
-        return call()
-    except pymongo.errors.ServerSelectionTimeoutError:
-        logger.error("Database connection timeout")
-        abort(503, "Database connection timeout")
+        yield
+    except CircuitOpen as e:
+        abort(database_unavailable(e.retry_after))
+    except DB_UNAVAILABLE as e:
+        logger.error(f"Database unavailable: {e}")
+        abort(database_unavailable(1))
+
+
+def database_unavailable(retry_after):
+    response = jsonify({"msg": "Database unavailable, please retry"})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(round(retry_after))
+    return response
 
 
 @app.route('/health-check', methods=['GET'])
@@ -44,28 +394,27 @@ def healthcheck():
 
 
 @app.route('/api/register', methods=['POST'])
+@validate_json(CREDENTIALS_SCHEMA)
 def register():
     users = mongo.db.users
-    username = request.json.get('username', None)
-    password = request.json.get('password', None)
+    username = g.body['username']
+    password = g.body['password']
 
-    if not username or not password:
-        return jsonify({"msg": "Missing username or password"}), 400
-
-    if users.find_one({"username": username}):
+    if handle_db_call(lambda: users.find_one({"username": username})):
         return jsonify({"msg": "Username already exists"}), 409
 
-    users.insert_one({"username": username, "password": password})
+    handle_db_call(lambda: users.insert_one({"username": username, "password": password}), retry=False)
     return jsonify({"msg": "User registered successfully"}), 201
 
 
 @app.route('/api/login', methods=['POST'])
+@validate_json(CREDENTIALS_SCHEMA)
 def login():
     users = mongo.db.users
-    username = request.json.get('username', None)
-    password = request.json.get('password', None)
+    username = g.body['username']
+    password = g.body['password']
 
-    user = users.find_one({"username": username, "password": password})
+    user = handle_db_call(lambda: users.find_one({"username": username, "password": password}))
 
     if not user:
         return jsonify({"msg": "Bad username or password"}), 401
@@ -77,26 +426,138 @@ def login():
 @app.route('/api/check_username', methods=['GET'])
 def check_username():
     username = request.args.get('username')
-    user_exists = mongo.db.users.find_one({"username": username})
+    user_exists = handle_db_call(lambda: mongo.db.users.find_one({"username": username}))
     return jsonify({"available": not bool(user_exists)}), 200
 
 
+def record_write(collection, document):
+    """Inserts an audit record, through the write-behind buffer when it is enabled."""
+    if write_behind:
+        try:
+            return write_behind.add(collection, document)
+        except BufferFull:
+            logger.warning(f"Write-behind buffer full, inserting into {collection} directly")
+    try:
+        return mongo.db[collection].insert_one(document).inserted_id
+    except pymongo.errors.DuplicateKeyError:
+        # A retry after a lost acknowledgement; the insert already landed
+        return document['_id']
+
+
+def find_with_buffered(collection, user):
+    """Finds a user's records, including any still waiting in the write-behind buffer."""
+    # Snapshot the buffer first: a record flushed between the two reads is
+    # then found by the query, and a duplicate is dropped below
+    buffered = write_behind.pending(collection, 'user', user) if write_behind else []
+    documents = list(mongo.db[collection].find({'user': user}))
+    seen = {document['_id'] for document in documents}
+    return documents + [document for document in buffered if document['_id'] not in seen]
+
+
+def find_catalog(collection, has_stock):
+    try:
+        query, sort, hint, limit = build_catalog_query(request.args, has_stock)
+    except CatalogQueryError as e:
+        return jsonify({"msg": str(e)}), 400
+    query.update(LIVE)
+
+    documents = handle_db_call(lambda: list(collection.find(query, HIDDEN).sort(sort).hint(hint).limit(limit)))
+    if collection.name == 'services':
+        documents = [to_api('services', document) for document in documents]
+    return dumps(documents)
+
+
+def build_catalog(collection):
+    documents = db_guard.call(lambda: list(mongo.db[collection].find(LIVE, HIDDEN)))
+    if collection == 'services':
+        documents = [to_api('services', document) for document in documents]
+    return json_util.dumps(documents).encode()
+
+
+# The unfiltered catalog is the same for every visitor, so it is served from
+# prebuilt snapshots refreshed every CATALOG_SNAPSHOT_TTL seconds (0 disables)
+CATALOG_SNAPSHOT_TTL = float(os.getenv('CATALOG_SNAPSHOT_TTL', 5))
+catalog_snapshots = {
+    collection: CatalogSnapshot(
+        collection,
+        build=lambda collection=collection: build_catalog(collection),
+        marker=lambda collection=collection: db_guard.call(lambda: latest_change(mongo.db[collection])),
+        ttl=CATALOG_SNAPSHOT_TTL,
+        max_stale=float(os.getenv('CATALOG_SNAPSHOT_MAX_STALE', 60)))
+    for collection in ('products', 'services')
+} if CATALOG_SNAPSHOT_TTL > 0 else {}
+
+
+# Endpoints that write to a catalog collection, by the collection they write
+CATALOG_WRITES = {
+    'create_product': 'products',
+    'shard_product_stock': 'products',
+    'purchase_product': 'products',
+    'reserve_product': 'products',
+    'release_reservation': 'products',
+    'delete_product': 'products',
+    'create_service': 'services',
+    'delete_service': 'services',
+}
+
+
+@app.after_request
+def invalidate_catalog_snapshots(response):
+    # Only prompts a marker check, which rebuilds if the write changed
+    # anything; other instances' writes are picked up once the ttl passes
+    collection = CATALOG_WRITES.get(request.endpoint)
+    if collection in catalog_snapshots and response.status_code < 400:
+        catalog_snapshots[collection].invalidate()
+    return response
+
+
+def serve_snapshot(collection):
+    """Returns the catalog snapshot response, or None to fall back to a query."""
+    if collection not in catalog_snapshots:
+        return None
+    with database_errors():
+        snapshot = catalog_snapshots[collection].get()
+    if snapshot is None:
+        return None
+
+    if request.if_none_match.contains_weak(snapshot.etag):
+        response = Response(status=304)
+    elif request.accept_encodings['gzip']:
+        response = Response(snapshot.gzipped)
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = Response(snapshot.body)
+    response.set_etag(snapshot.etag, weak=True)
+    response.vary.add('Accept-Encoding')
+    return response
+
+
 @app.route('/api/products', methods=['GET'])
 def get_products():
     try:
-        products = handle_db_call(lambda: list(mongo.db.products.find()))
-        return json_util.dumps(products)
+        if is_filtered(request.args):
+            return find_catalog(mongo.db.products, has_stock=True)
+        response = serve_snapshot('products')
+        if response is not None:
+            return response
+        products = handle_db_call(lambda: list(mongo.db.products.find(LIVE, HIDDEN)))
+        return dumps(products)
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Failed to retrieve products: {e}")
         abort(500, "Internal Server Error")
 
 
-@app.route('/api/products/<product_id>', methods=['GET'])
+@app.route('/api/products/<objectid:product_id>', methods=['GET'])
 def get_product(product_id):
     try:
         product = handle_db_call(
-            lambda: mongo.db.products.find_one_or_404({'_id': ObjectId(product_id)}))
-        return json_util.dumps(product)
+            lambda: mongo.db.products.find_one_or_404({'_id': ObjectId(product_id), **LIVE}, HIDDEN))
+        product['quantity'] = handle_db_call(lambda: current_quantity(product))
+        return dumps(product)
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Failed to retrieve product {product_id}: {e}")
         abort(500, "Internal Server Error")
@@ -104,29 +565,108 @@ def get_product(product_id):
 
 @app.route('/api/products', methods=['POST'])
 @jwt_required()
+@validate_json(PRODUCT_SCHEMA)
+@idempotency.idempotent
 def create_product():
     current_user = get_jwt_identity()
-    product_data = request.json
-    if 'user' not in product_data or product_data['user'] != current_user:
+    product_data = g.body
+    if product_data['user'] != current_user:
         return jsonify({"msg": "Unauthorized: User mismatch"}), 403
 
-    required_fields = ['user', 'description', 'price', 'quantity']
-    missing_fields = [field for field in required_fields if field not in product_data or not product_data[field]]
-    if missing_fields:
-        return jsonify({"msg": f"Missing or empty required fields for product listing: {', '.join(missing_fields)}"}), 400
-    
     product_id = handle_db_call(
-        lambda: mongo.db.products.insert_one(product_data).inserted_id)
-    return json_util.dumps({"message": "Product created successfully", "product_id": str(product_id)}), 201
+        lambda: mongo.db.products.insert_one(created(product_data)).inserted_id, retry=False)
+    return dumps({"message": "Product created successfully", "product_id": str(product_id)}), 201
+
+
+def take_stock(product, units, hold=None):
+    """Atomically removes units from a product's stock, returning False if fewer remain.
+
+    A take for a hold records the hold on the stock document in the same
+    update, so untake_stock can tell whether it landed.
+    """
+    if product.get('shards'):
+        return sharded_stock.take(product['_id'], product['shards'], units, hold)
+
+    update = {'$inc': {'quantity': -units}}
+    if hold is not None:
+        update['$push'] = {'held_by': {'id': hold, 'units': units}}
+    result = mongo.db.products.update_one(
+        {'_id': product['_id'], 'shards': {'$exists': False}, 'quantity': {'$gte': units}, **LIVE},
+        touch(update))
+    return result.modified_count == 1
+
+
+def untake_stock(product_id, hold, units):
+    """Returns the stock a hold took, returning False if its take never landed
+    or was already returned or settled."""
+    result = mongo.db.products.update_one(
+        {'_id': product_id, 'shards': {'$exists': False}, 'held_by.id': hold},
+        touch({'$inc': {'quantity': units}, '$pull': {'held_by': {'id': hold}}}))
+    if result.modified_count:
+        return True
+    # Taken before the product's stock was sharded, so it goes to the shards
+    result = mongo.db.products.update_one({'_id': product_id, 'held_by.id': hold},
+                                          {'$pull': {'held_by': {'id': hold}}})
+    if result.modified_count:
+        sharded_stock.put(product_id, units)
+        return True
+    return sharded_stock.untake(product_id, hold)
+
+
+def settle_stock(product_id, hold):
+    # Once the hold records its stock, the stock no longer needs to record the hold
+    mongo.db.products.update_one({'_id': product_id, 'held_by.id': hold}, {'$pull': {'held_by': {'id': hold}}})
+    sharded_stock.settle(product_id, hold)
+
+
+def return_held_stock(reservation):
+    """Returns the stock of a reservation that was just closed, given as it
+    was before closing."""
+    if untake_stock(reservation['product_id'], reservation['_id'], reservation['quantity']):
+        return
+    if reservation['status'] == 'held':
+        return_stock(reservation['product_id'], reservation['quantity'])
+
+
+def return_stock(product_id, units):
+    result = mongo.db.products.update_one(
+        {'_id': product_id, 'shards': {'$exists': False}}, touch({'$inc': {'quantity': units}}))
+    if result.matched_count == 0:
+        sharded_stock.put(product_id, units)
+
+
+def current_quantity(product):
+    if product.get('shards'):
+        return sharded_stock.total(product['_id'])
+    return product.get('quantity', 0)
+
+
+@app.route('/api/products/<objectid:product_id>/shard_stock', methods=['POST'])
+@jwt_required()
+@validate_json(SHARD_STOCK_SCHEMA)
+def shard_product_stock(product_id):
+    current_user = get_jwt_identity()
+    shard_count = g.body['shards']
+
+    product = handle_db_call(lambda: mongo.db.products.find_one({'_id': ObjectId(product_id), **LIVE}, {'user': 1}))
+    if not product:
+        return jsonify({"msg": "Product not found"}), 404
+    if product['user'] != current_user:
+        return jsonify({"msg": "Unauthorized to modify this product"}), 403
 
+    if not handle_db_call(lambda: sharded_stock.enable(product['_id'], shard_count), retry=False):
+        return jsonify({"msg": "Product stock is already sharded"}), 409
+    return jsonify({"msg": "Product stock sharded successfully", "shards": shard_count}), 200
 
-@app.route('/api/purchase_product/<product_id>', methods=['POST'])
+
+@app.route('/api/purchase_product/<objectid:product_id>', methods=['POST'])
 @jwt_required()
+@idempotency.idempotent
 def purchase_product(product_id):
     current_user = get_jwt_identity()
 
     # Find the product to purchase
-    product = mongo.db.products.find_one({'_id': ObjectId(product_id)})
+    product = handle_db_call(lambda: mongo.db.products.find_one({'_id': ObjectId(product_id), **LIVE}))
     if not product:
         return jsonify({"msg": "Product not found"}), 404
     elif product['user'] == current_user:
@@ -134,68 +674,240 @@ def purchase_product(product_id):
     elif product['quantity'] == 0:
         return jsonify({"msg": "Product is not available"}), 409
 
-    # Decrement the product quantity and update the database
-    mongo.db.products.update_one({'_id': ObjectId(product_id)}, {'$inc': {'quantity': -1}})
+    # Decrement the product quantity, unless another buyer took the last one
+    if not handle_db_call(lambda: take_stock(product, 1), retry=False):
+        return jsonify({"msg": "Product is not available"}), 409
 
     # Record the purchase in the purchases collection
     purchase_data = {
         'user': current_user,
-        'product_id': product_id,
+        'product_id': storage.ref(product_id),
+        'seller': product['user'],
+        'price': product.get('price'),
         'purchase_time': datetime.now(),
     }
-    mongo.db.purchases.insert_one(purchase_data)
+    handle_db_call(lambda: record_write('purchases', purchase_data))
 
     return jsonify({"msg": "Product purchased successfully", "product_id": str(product_id)}), 200
 
 
-@app.route('/api/products/<product_id>/is_sold_out', methods=['GET'])
+@app.route('/api/products/<objectid:product_id>/reservations', methods=['POST'])
+@jwt_required()
+@validate_json(RESERVATION_SCHEMA)
+@idempotency.idempotent
+def reserve_product(product_id):
+    current_user = get_jwt_identity()
+    units = g.body['quantity']
+
+    product = handle_db_call(lambda: mongo.db.products.find_one(
+        {'_id': ObjectId(product_id), **LIVE}, {'user': 1, 'price': 1, 'shards': 1}))
+    if not product:
+        return jsonify({"msg": "Product not found"}), 404
+    elif product['user'] == current_user:
+        return jsonify({"msg": "Sellers cannot buy their own products"}), 403
+
+    # The hold is saved before any stock is taken, so whatever happens to
+    # this request, the sweeper finds it once it expires and returns what
+    # its take left on the stock
+    now = datetime.utcnow()
+    reservation = {
+        'product_id': product['_id'],
+        'user': current_user,
+        'seller': product['user'],
+        'price': product.get('price'),
+        'quantity': units,
+        'status': 'pending',
+        'created_at': now,
+        'expires_at': now + timedelta(seconds=RESERVATION_TTL),
+    }
+    reservation_id = reservation['_id'] = ObjectId()
+    handle_db_call(lambda: insert_reservation(reservation))
+
+    if not handle_db_call(lambda: take_stock(product, units, hold=reservation_id), retry=False):
+        handle_db_call(lambda: mongo.db.reservations.update_one(
+            {'_id': reservation_id, 'status': 'pending'},
+            {'$set': {'status': 'released', 'closed_at': datetime.utcnow()}}))
+        return jsonify({"msg": "Not enough stock to reserve"}), 409
+
+    if not handle_db_call(lambda: mongo.db.reservations.update_one(
+            {'_id': reservation_id, 'status': 'pending'}, {'$set': {'status': 'held'}}).matched_count):
+        # The sweeper expired the hold first; give back the stock it missed
+        handle_db_call(lambda: untake_stock(product['_id'], reservation_id, units), retry=False)
+        return jsonify({"msg": "Reservation has expired"}), 410
+    handle_db_call(lambda: settle_stock(product['_id'], reservation_id))
+
+    return dumps({"message": "Product reserved successfully",
+                            "reservation_id": str(reservation_id),
+                            "expires_at": reservation['expires_at'].isoformat() + 'Z'}), 201
+
+
+def insert_reservation(reservation):
+    try:
+        mongo.db.reservations.insert_one(reservation)
+    except pymongo.errors.DuplicateKeyError:
+        # A retry after a lost acknowledgement; the insert already landed
+        pass
+
+
+def close_reservation(reservation_id, user, status):
+    """Moves a held, unexpired reservation to status, returning an error response if it can't be."""
+    now = datetime.utcnow()
+    reservation = handle_db_call(lambda: mongo.db.reservations.find_one_and_update(
+        {'_id': ObjectId(reservation_id), 'user': user, 'status': 'held', 'expires_at': {'$gt': now}},
+        {'$set': {'status': status, 'closed_at': now}}))
+    if reservation:
+        return reservation, None
+
+    reservation = handle_db_call(lambda: mongo.db.reservations.find_one({'_id': ObjectId(reservation_id)}))
+    if not reservation or reservation['user'] != user:
+        return None, (jsonify({"msg": "Reservation not found"}), 404)
+    if reservation['status'] in ('held', 'expired'):
+        return None, (jsonify({"msg": "Reservation has expired"}), 410)
+    return None, (jsonify({"msg": f"Reservation is already {reservation['status']}"}), 409)
+
+
+@app.route('/api/reservations/<objectid:reservation_id>/confirm', methods=['POST'])
+@jwt_required()
+@idempotency.idempotent
+def confirm_reservation(reservation_id):
+    current_user = get_jwt_identity()
+    reservation, error = close_reservation(reservation_id, current_user, 'confirmed')
+    if error:
+        return error
+
+    purchase_data = {
+        'user': current_user,
+        'product_id': storage.ref(reservation['product_id']),
+        'seller': reservation.get('seller'),
+        'price': reservation.get('price'),
+        'quantity': reservation['quantity'],
+        'reservation_id': reservation['_id'],
+        'purchase_time': datetime.now(),
+    }
+    handle_db_call(lambda: record_write('purchases', purchase_data))
+
+    return jsonify({"msg": "Product purchased successfully", "product_id": str(reservation['product_id']),
+                    "quantity": reservation['quantity']}), 200
+
+
+@app.route('/api/reservations/<objectid:reservation_id>', methods=['DELETE'])
+@jwt_required()
+def release_reservation(reservation_id):
+    current_user = get_jwt_identity()
+    reservation, error = close_reservation(reservation_id, current_user, 'released')
+    if error:
+        return error
+
+    handle_db_call(lambda: return_held_stock(reservation), retry=False)
+    return jsonify({"msg": "Reservation released successfully"}), 200
+
+
+def release_expired_reservations():
+    """Returns the stock held by every expired reservation, claiming each one first
+    so that concurrent sweepers and confirmations never return it twice. Holds
+    still pending, left by a request that died, only give back what their
+    take left on the stock."""
+    released = 0
+    while True:
+        now = datetime.utcnow()
+        reservation = mongo.db.reservations.find_one_and_update(
+            {'status': {'$in': ['held', 'pending']}, 'expires_at': {'$lte': now}},
+            {'$set': {'status': 'expired', 'closed_at': now}})
+        if not reservation:
+            return released
+        return_held_stock(reservation)
+        released += 1
+
+
+def run_reservation_sweeper():
+    while True:
+        time.sleep(RESERVATION_SWEEP_INTERVAL)
+        try:
+            released = release_expired_reservations()
+            if released:
+                logger.info(f"Released {released} expired reservations")
+        except pymongo.errors.PyMongoError as e:
+            logger.error(f"Failed to release expired reservations: {e}")
+
+
+threading.Thread(target=run_reservation_sweeper, name='reservation-sweeper', daemon=True).start()
+
+
+def run_sales_rollups():
+    # Folds can outlast the request socket timeout, so they get a client of their own
+    db = maintenance_db()
+    while True:
+        time.sleep(SALES_ROLLUP_INTERVAL)
+        try:
+            fold_sales(db)
+        except pymongo.errors.PyMongoError as e:
+            logger.error(f"Failed to fold sales into the rollups: {e}")
+
+
+threading.Thread(target=run_sales_rollups, name='sales-rollups', daemon=True).start()
+
+
+@app.route('/api/products/<objectid:product_id>/is_sold_out', methods=['GET'])
 def is_product_sold_out(product_id):
     try:
-        product = mongo.db.products.find_one({'_id': ObjectId(product_id)})
+        product = handle_db_call(lambda: mongo.db.products.find_one({'_id': ObjectId(product_id), **LIVE}))
 
         if not product:
             return jsonify({"msg": "Product not found"}), 404
         
-        is_sold_out = product.get('quantity', 0) <= 0
+        is_sold_out = handle_db_call(lambda: current_quantity(product)) <= 0
         return jsonify({"product_id": str(product_id), "is_sold_out": is_sold_out}), 200
 
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Failed to check if product {product_id} is sold out: {e}")
         return jsonify({"msg": "Internal Server Error"}), 500
 
 
-@app.route('/api/products/<product_id>', methods=['DELETE'])
+@app.route('/api/products/<objectid:product_id>', methods=['DELETE'])
 @jwt_required()
 def delete_product(product_id):
     current_user = get_jwt_identity()
 
-    product = mongo.db.products.find_one({'_id': ObjectId(product_id)})
+    product = handle_db_call(lambda: mongo.db.products.find_one({'_id': ObjectId(product_id), **LIVE}))
     if not product:
         return jsonify({"msg": "Product not found"}), 404
 
     if product['user'] != current_user:
         return jsonify({"msg": "Unauthorized to delete this product"}), 403
 
-    mongo.db.products.delete_one({'_id': ObjectId(product_id)})
+    handle_db_call(lambda: mongo.db.products.update_one({'_id': ObjectId(product_id), **LIVE}, tombstone()))
+    if product.get('shards'):
+        handle_db_call(lambda: sharded_stock.delete(product['_id']))
     return jsonify({"msg": "Product deleted successfully"}), 200
 
 
 @app.route('/api/services', methods=['GET'])
 def get_services():
     try:
-        services = handle_db_call(lambda: list(mongo.db.services.find()))
-        return json_util.dumps(services)
+        if is_filtered(request.args):
+            return find_catalog(mongo.db.services, has_stock=False)
+        response = serve_snapshot('services')
+        if response is not None:
+            return response
+        services = handle_db_call(lambda: list(mongo.db.services.find(LIVE)))
+        return dumps([to_api('services', service) for service in services])
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Failed to retrieve services: {e}")
         abort(500, "Internal Server Error")
 
 
-@app.route('/api/services/<service_id>', methods=['GET'])
+@app.route('/api/services/<objectid:service_id>', methods=['GET'])
 def get_service(service_id):
     try:
         service = handle_db_call(
-            lambda: mongo.db.services.find_one_or_404({'_id': ObjectId(service_id)}))
-        return json_util.dumps(service)
+            lambda: mongo.db.services.find_one_or_404({'_id': ObjectId(service_id), **LIVE}))
+        return dumps(to_api('services', service))
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Failed to retrieve service {service_id}: {e}")
         abort(500, "Internal Server Error")
@@ -203,32 +915,32 @@ def get_service(service_id):
 
 @app.route('/api/services', methods=['POST'])
 @jwt_required()
+@validate_json(SERVICE_SCHEMA)
+@idempotency.idempotent
 def create_service():
     try:
         current_user = get_jwt_identity()
-        service_data = request.json
-        if 'user' not in service_data or service_data['user'] != current_user:    
+        service_data = g.body
+        if service_data['user'] != current_user:
             return jsonify({"msg": "Unauthorized: User mismatch"}), 403
+        service_data['available_dates'] = storage.times(service_data['available_dates'])
 
-        required_fields = ['user', 'description', 'price', 'available_dates']
-        missing_fields = [field for field in required_fields if field not in service_data or not service_data[field]]
-        if missing_fields:
-            return jsonify({"msg": f"Missing or empty required fields for service listing: {', '.join(missing_fields)}"}), 400
-      
         service_id = handle_db_call(
-            lambda: mongo.db.services.insert_one(service_data).inserted_id)
-        return json_util.dumps({"message": "service created successfully", "service_id": str(service_id)}), 201
+            lambda: mongo.db.services.insert_one(created(service_data)).inserted_id, retry=False)
+        return dumps({"message": "service created successfully", "service_id": str(service_id)}), 201
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Failed to create service: {e}")
         abort(500, "Internal Server Error")
 
 
-@app.route('/api/services/<service_id>', methods=['DELETE'])
+@app.route('/api/services/<objectid:service_id>', methods=['DELETE'])
 @jwt_required()
 def delete_service(service_id):
     current_user = get_jwt_identity()
 
-    service = mongo.db.services.find_one({'_id': ObjectId(service_id)})
+    service = handle_db_call(lambda: mongo.db.services.find_one({'_id': ObjectId(service_id), **LIVE}))
     if not service:
         return jsonify({"msg": "Service not found"}), 404
 
@@ -236,21 +948,23 @@ def delete_service(service_id):
         return jsonify({"msg": "Unauthorized to delete this service"}), 403
 
     # Delete the service
-    mongo.db.services.delete_one({'_id': ObjectId(service_id)})
+    handle_db_call(lambda: mongo.db.services.update_one({'_id': ObjectId(service_id), **LIVE}, tombstone()))
     
     # Delete all appointments for this service
-    mongo.db.appointments.delete_many({'service_id': service_id})
+    handle_db_call(lambda: mongo.db.appointments.delete_many({'service_id': match_ref(service_id)}))
 
     return jsonify({"msg": "Service and associated appointments deleted successfully"}), 200
 
 
-@app.route('/api/appointments/<service_id>', methods=['GET'])
+@app.route('/api/appointments/<objectid:service_id>', methods=['GET'])
 def get_appointments_for_service(service_id):
     try:
         appointments = handle_db_call(lambda: list(
-            mongo.db.appointments.find({'service_id': service_id})))
-        return json_util.dumps(appointments)
+            mongo.db.appointments.find({'service_id': match_ref(service_id)})))
+        return dumps([to_api('appointments', appointment) for appointment in appointments])
 
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(
             f"Failed to retrieve appointments for service {service_id}: {e}")
@@ -259,67 +973,76 @@ def get_appointments_for_service(service_id):
 
 @app.route('/api/appointments', methods=['POST'])
 @jwt_required()
+@validate_json(APPOINTMENT_SCHEMA)
+@idempotency.idempotent
 def book_appointment():
     try:
         current_user = get_jwt_identity()
-        appointment_data = request.json
-        if 'user' not in appointment_data or appointment_data['user'] != current_user:
+        appointment_data = g.body
+        if appointment_data['user'] != current_user:
             return jsonify({"msg": "Unauthorized: User mismatch"}), 403
 
-        if not all(key in appointment_data for key in ['service_id', 'timeslot', 'user']):
-            return jsonify({"msg": "Missing required fields for appointment"}), 400
-
         service = handle_db_call(lambda: mongo.db.services.find_one(
-            {'_id': ObjectId(appointment_data['service_id'])}))
+            {'_id': ObjectId(appointment_data['service_id']), **LIVE}))
 
         if not service:
             return jsonify({"msg": "Service not found"}), 404
 
         existing_appointment = handle_db_call(lambda: mongo.db.appointments.find_one({
-            'service_id': appointment_data['service_id'],
-            'timeslot': appointment_data['timeslot']
+            'service_id': match_ref(appointment_data['service_id']),
+            'timeslot': match_time(appointment_data['timeslot'])
         }))
 
         if existing_appointment:
             return jsonify({"msg":  "Appointment already booked for this timeslot"}), 409
 
+        appointment_data['service_id'] = storage.ref(appointment_data['service_id'])
+        appointment_data['timeslot'] = storage.time(appointment_data['timeslot'])
+
         appointment_id = handle_db_call(
-            lambda: mongo.db.appointments.insert_one(appointment_data).inserted_id)
+            lambda: mongo.db.appointments.insert_one(appointment_data).inserted_id, retry=False)
 
         booking_data = {
             'user': current_user,
             'appointment_id': appointment_id,
+            'service_id': service['_id'],
+            'seller': service['user'],
+            'price': service.get('price'),
             'booking_time': datetime.now()
         }
-        mongo.db.bookings.insert_one(booking_data)
+        handle_db_call(lambda: record_write('bookings', booking_data))
 
-        return json_util.dumps({"message": "Appointment booked successfully", "appointment_id": str(appointment_id)}), 200
+        return dumps({"message": "Appointment booked successfully", "appointment_id": str(appointment_id)}), 200
+    except HTTPException:
+        raise
     except Exception as e:
-        logger.error(f"Failed to book an appointment for service {service_id}: {e}")
+        logger.error(f"Failed to book an appointment: {e}")
         abort(500, "Internal Server Error")
 
-@app.route('/api/bookable_dates/<service_id>', methods=['GET'])
+@app.route('/api/bookable_dates/<objectid:service_id>', methods=['GET'])
 def get_bookable_dates(service_id):
     try:
         # Fetch the service to get its available dates
-        service = mongo.db.services.find_one({'_id': ObjectId(service_id)})
+        service = handle_db_call(lambda: mongo.db.services.find_one({'_id': ObjectId(service_id), **LIVE}))
         if not service:
             return jsonify({"message": "Service not found"}), 404
         
-        bookable_dates = service.get('available_dates', [])
+        bookable_dates = to_api('services', service).get('available_dates', [])
 
         return jsonify({"bookable_dates": bookable_dates}), 200
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Failed to get bookable dates for service {service_id}: {e}")
         abort(500, "Internal Server Error")
 
 
-@app.route('/api/appointments/<appointment_id>', methods=['DELETE'])
+@app.route('/api/appointments/<objectid:appointment_id>', methods=['DELETE'])
 @jwt_required()
 def delete_appointment(appointment_id):
     current_user = get_jwt_identity()
 
-    appointment = mongo.db.appointments.find_one({'_id': ObjectId(appointment_id)})
+    appointment = handle_db_call(lambda: mongo.db.appointments.find_one({'_id': ObjectId(appointment_id)}))
     if not appointment:
         return jsonify({"msg": "Appointment not found"}), 404
 
@@ -327,18 +1050,177 @@ def delete_appointment(appointment_id):
         return jsonify({"msg": "Unauthorized to delete this appointment"}), 403
 
     # Delete the appointment
-    mongo.db.appointments.delete_one({'_id': ObjectId(appointment_id)})
+    handle_db_call(lambda: mongo.db.appointments.delete_one({'_id': ObjectId(appointment_id)}))
 
     return jsonify({"msg": "Appointment deleted successfully"}), 200
 
 
+def json_value(value):
+    # Datetimes in change events are sent as ISO strings, like the REST API
+    return value.isoformat() if isinstance(value, datetime) else str(value)
+
+
+@app.route('/api/stream', methods=['GET'])
+def stream_updates():
+    product_ids = [id for id in request.args.get('products', '').split(',') if id]
+    service_ids = [id for id in request.args.get('services', '').split(',') if id]
+    if not product_ids and not service_ids:
+        return jsonify({"msg": "Provide products and/or services to subscribe to"}), 400
+    if len(product_ids) + len(service_ids) > STREAM_MAX_IDS:
+        return jsonify({"msg": f"At most {STREAM_MAX_IDS} ids can be subscribed to"}), 400
+    if not all(ObjectId.is_valid(id) for id in product_ids + service_ids):
+        return jsonify({"msg": "Invalid id"}), 400
+
+    keys = [('products', id) for id in product_ids] + [('services', id) for id in service_ids]
+    subscription = change_hub.subscribe(keys)
+    if subscription is None:
+        response = jsonify({"msg": "Too many open streams, please retry"})
+        response.headers['Retry-After'] = '5'
+        return response, 503
+
+    # Snapshot after subscribing, so no change can fall between the two
+    try:
+        products = handle_db_call(lambda: list(mongo.db.products.find(
+            {'_id': {'$in': [ObjectId(id) for id in product_ids]}, **LIVE}, {'quantity': 1})))
+        services = handle_db_call(lambda: list(mongo.db.services.find(
+            {'_id': {'$in': [ObjectId(id) for id in service_ids]}, **LIVE}, {'available_dates': 1})))
+    except Exception:
+        change_hub.unsubscribe(subscription)
+        raise
+
+    def format_event(name, data):
+        return f"event: {name}\ndata: {json.dumps(data, default=json_value)}\n\n"
+
+    def generate():
+        try:
+            for product in products:
+                yield format_event('product', {'id': str(product['_id']), 'quantity': product.get('quantity')})
+            for service in services:
+                service = to_api('services', service)
+                yield format_event('service', {'id': str(service['_id']), 'available_dates': service.get('available_dates', [])})
+
+            deadline = time.monotonic() + STREAM_MAX_SECONDS
+            while not subscription.closed and time.monotonic() < deadline:
+                try:
+                    collection, event = subscription.events.get(timeout=STREAM_HEARTBEAT_SECONDS)
+                except queue.Empty:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield format_event('product' if collection == 'products' else 'service', event)
+        finally:
+            change_hub.unsubscribe(subscription)
+
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@app.route('/api/batch', methods=['POST'])
+def batch_requests():
+    try:
+        items = batch_runner.parse(request.get_json(silent=True))
+    except BatchError as e:
+        return jsonify({"msg": str(e)}), 400
+
+    results = batch_runner.run(items, request.headers.get('Authorization'), request.remote_addr)
+    return jsonify({"responses": results}), 200
+
+
 @app.route('/api/products/search', methods=['GET'])
 def search_products():
     title = request.args.get('title', '')
+    if len(title) > 100:
+        return jsonify({"msg": "Search title must be at most 100 characters"}), 400
     products = handle_db_call(
-        lambda: mongo.db.products.find({"description": {"$regex": title, "$options": "i"}})
+        lambda: list(mongo.db.products.find({"description": {"$regex": re.escape(title), "$options": "i"}, **LIVE}, HIDDEN))
     )
-    return json_util.dumps({"products": products}), 200
+    return dumps({"products": products}), 200
+
+
+def catalog_changes(collection):
+    """Lists the documents of collection changed since the client's sync token."""
+    try:
+        limit = int(request.args.get('limit', 100))
+    except ValueError:
+        return jsonify({"msg": "limit must be an integer"}), 400
+    if not 1 <= limit <= CHANGES_MAX_LIMIT:
+        return jsonify({"msg": f"limit must be between 1 and {CHANGES_MAX_LIMIT}"}), 400
+
+    try:
+        documents, next_token, has_more = handle_db_call(lambda: changes_since(
+            mongo.db[collection], request.args.get('since'), limit, CHANGES_SETTLE_SECONDS, TOMBSTONE_RETENTION))
+    except SyncTokenError as e:
+        return jsonify({"msg": str(e)}), e.status
+
+    changes = []
+    for document in documents:
+        if document.get('deleted'):
+            changes.append({'_id': document['_id'], 'deleted': True,
+                            'updated_at': document['updated_at'], 'version': document.get('version')})
+        elif collection == 'services':
+            changes.append(to_api('services', document))
+        else:
+            changes.append(document)
+    return dumps({"changes": changes, "next": next_token, "has_more": has_more}), 200
+
+
+@app.route('/api/products/changes', methods=['GET'])
+def get_product_changes():
+    return catalog_changes('products')
+
+
+@app.route('/api/services/changes', methods=['GET'])
+def get_service_changes():
+    return catalog_changes('services')
+
+
+@app.route('/api/user/sales', methods=['GET'])
+@jwt_required()
+def get_user_sales():
+    current_user = get_jwt_identity()
+    try:
+        days = int(request.args.get('days', 30))
+    except ValueError:
+        return jsonify({"msg": "days must be an integer"}), 400
+    if not 1 <= days <= 366:
+        return jsonify({"msg": "days must be between 1 and 366"}), 400
+
+    sales = handle_db_call(lambda: seller_sales(mongo.db, current_user, days))
+    return jsonify(sales), 200
+
+
+@app.route('/api/user/listings', methods=['GET'])
+@jwt_required()
+def get_user_listings():
+    current_user = get_jwt_identity()
+    after = request.args.get('after')
+    if after is not None and not ObjectId.is_valid(after):
+        return jsonify({"msg": "after must be a listing id"}), 400
+    try:
+        limit = int(request.args.get('limit', 50))
+    except ValueError:
+        return jsonify({"msg": "limit must be an integer"}), 400
+    if not 1 <= limit <= LISTINGS_MAX_LIMIT:
+        return jsonify({"msg": f"limit must be between 1 and {LISTINGS_MAX_LIMIT}"}), 400
+
+    listings, has_more = handle_db_call(
+        lambda: seller_listings(mongo.db, current_user, after and ObjectId(after), limit))
+    listings = [to_api('services', listing) for listing in listings]
+    return dumps({"listings": listings, "next": str(listings[-1]['_id']) if has_more else None}), 200
+
+
+@app.route('/api/admin/slow_queries', methods=['GET'])
+@jwt_required()
+def get_slow_queries():
+    if get_jwt_identity() not in ADMIN_USERS:
+        return jsonify({"msg": "Admin access required"}), 403
+    return dumps({"threshold_ms": slow_queries.threshold_ms, "slow_queries": slow_queries.recent()[::-1]}), 200
+
+
+def wants_archive():
+    # History older than ARCHIVE_AFTER_DAYS is only read when asked for
+    return request.args.get('include_archive', '').lower() in ('1', 'true', 'yes')
 
 
 @app.route('/api/user/appointments_and_bookings', methods=['GET'])
@@ -347,11 +1229,18 @@ def get_user_appointments_and_bookings():
     try:
         current_user = get_jwt_identity()
 
-        user_appointments = handle_db_call(lambda: mongo.db.appointments.find({'user': current_user}))
+        user_appointments = handle_db_call(lambda: list(mongo.db.appointments.find({'user': current_user})))
+
+        user_bookings = handle_db_call(lambda: find_with_buffered('bookings', current_user))
 
-        user_bookings = handle_db_call(lambda: mongo.db.bookings.find({'user': current_user}))
+        if wants_archive():
+            user_appointments += handle_db_call(lambda: read_archive(mongo.db, 'appointments', current_user))
+            user_bookings += handle_db_call(lambda: read_archive(mongo.db, 'bookings', current_user))
 
-        return json_util.dumps({"user_appointments": user_appointments, "user_bookings": user_bookings}), 200
+        user_appointments = [to_api('appointments', appointment) for appointment in user_appointments]
+        return dumps({"user_appointments": user_appointments, "user_bookings": user_bookings}), 200
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Failed to retrieve appointments and bookings for user {current_user}: {e}")
         abort(500, "Internal Server Error")
@@ -362,10 +1251,57 @@ def get_user_purchases():
     try:
         current_user = get_jwt_identity()
 
-        user_purchases = handle_db_call(lambda: mongo.db.purchases.find({'user': current_user}))
+        user_purchases = handle_db_call(lambda: find_with_buffered('purchases', current_user))
+        if wants_archive():
+            user_purchases += handle_db_call(lambda: read_archive(mongo.db, 'purchases', current_user))
 
+        user_purchases = [to_api('purchases', purchase) for purchase in user_purchases]
         logger.info(f"Retrieved purchases for user {current_user}. {user_purchases}")
-        return json_util.dumps({"user_purchases": user_purchases}), 200
+        return dumps({"user_purchases": user_purchases}), 200
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Failed to retrieve purchases for user {current_user}: {e}")
-        abort(500, "Internal Server Error")
\ No newline at end of file
+        abort(500, "Internal Server Error")
+
+
+@app.cli.command('archive')
+@click.option('--days', default=ARCHIVE_AFTER_DAYS, show_default=True,
+              help='Archive records older than this many days.')
+@click.option('--compress/--no-compress', default=True, show_default=True)
+def archive_history(days, compress):
+    """Moves old purchases, bookings and appointments to the archive tier."""
+    cutoff = datetime.now() - timedelta(days=days)
+    db = maintenance_db()
+    # Sales stay put until they are folded into the rollups, and no rebuild
+    # may read them half moved
+    with exclusive(db, 3600):
+        counted = folded(db)
+        for name in ARCHIVES:
+            only = counted if name in SOURCES else None
+            moved = archive_collection(db, name, cutoff, compress=compress, only=only)
+            logger.info(f"Archived {moved} {name} older than {cutoff:%Y-%m-%d}")
+
+
+@app.cli.command('rebuild-rollups')
+def rebuild_rollups():
+    """Recomputes the seller sales rollups from purchase and booking history."""
+    rebuild(maintenance_db())
+    logger.info("Rebuilt sales rollups")
+
+
+@app.cli.command('migrate')
+@click.option('--batch-size', default=500, show_default=True, help='Documents converted per batch.')
+@click.option('--status', is_flag=True, help='Only show the state of each migration.')
+def migrate_schema(batch_size, status):
+    """Runs the pending data migrations, resuming any that was interrupted."""
+    db = maintenance_db()
+    if status:
+        states = {state['_id']: state for state in db[MIGRATIONS_COLLECTION].find()}
+        for migration in MIGRATIONS:
+            state = states.get(migration.version, {})
+            click.echo(f"{migration.version} {migration.description}: {state.get('state', 'pending')}"
+                       f" ({state.get('converted', 0)} converted)")
+        return
+    migrate(db, batch_size=batch_size)
+    logger.info("Migrations complete")
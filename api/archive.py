@@ -0,0 +1,95 @@
+import zlib
+from datetime import datetime
+
+import bson
+from bson import Binary
+
+# Collections with unbounded history: (field the record's age is taken from,
+# archive collection)
+ARCHIVES = {
+    'purchases': ('purchase_time', 'purchases_archive'),
+    'bookings': ('booking_time', 'bookings_archive'),
+    'appointments': ('timeslot', 'appointments_archive'),
+}
+
+
+def older_than(field, cutoff):
+    # Times are stored either as datetimes or as ISO strings; each branch only
+    # matches its own BSON type
+    return {'$or': [{field: {'$lt': cutoff}}, {field: {'$lt': cutoff.isoformat()}}]}
+
+
+def month_of(value):
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m')
+    return str(value)[:7]
+
+
+def archive_collection(db, name, cutoff, compress=True, batch_size=500, only=None):
+    """Moves records of name older than cutoff into its archive collection.
+
+    Records are written as buckets of one user's records for one month, each
+    listing the _ids it holds. Originals are only deleted once their bucket is
+    stored, and records some bucket already holds are not written again, so
+    re-running after a failure never duplicates a record, however the retry
+    groups them. With only, a filter, just the records matching it are
+    moved.
+    """
+    field, archive_name = ARCHIVES[name]
+    collection, archive = db[name], db[archive_name]
+    query = older_than(field, cutoff)
+    if only is not None:
+        query = {'$and': [query, only]}
+    moved = 0
+
+    while True:
+        records = list(collection.find(query).sort('_id', 1).limit(batch_size))
+        if not records:
+            return moved
+
+        # Held by a bucket stored before an earlier run failed
+        ids = [record['_id'] for record in records]
+        archived = {record_id for bucket in archive.find({'ids': {'$in': ids}}, {'ids': 1})
+                    for record_id in bucket['ids']}
+        buckets = {}
+        for record in records:
+            if record['_id'] in archived:
+                continue
+            buckets.setdefault((record.get('user'), month_of(record.get(field))), []).append(record)
+
+        for (user, month), grouped in buckets.items():
+            bucket = {
+                '_id': {'user': user, 'month': month, 'first': grouped[0]['_id']},
+                'user': user,
+                'month': month,
+                'count': len(grouped),
+                'ids': [record['_id'] for record in grouped],
+            }
+            if compress:
+                bucket['data'] = Binary(zlib.compress(bson.encode({'records': grouped})))
+            else:
+                bucket['records'] = grouped
+            archive.replace_one({'_id': bucket['_id']}, bucket, upsert=True)
+
+        collection.delete_many({'_id': {'$in': ids}})
+        moved += len(records)
+
+
+def bucket_records(bucket):
+    if 'data' in bucket:
+        return bson.decode(zlib.decompress(bucket['data']))['records']
+    return bucket['records']
+
+
+def read_archive(db, name, user):
+    """Returns every archived record of name belonging to user, newest month first."""
+    records = []
+    for bucket in db[ARCHIVES[name][1]].find({'user': user}).sort('month', -1):
+        records.extend(bucket_records(bucket))
+    return records
+
+
+def iter_archive(db, name):
+    """Yields the archived records of name one bucket at a time."""
+    for bucket in db[ARCHIVES[name][1]].find():
+        yield bucket_records(bucket)
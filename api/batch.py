@@ -0,0 +1,124 @@
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from werkzeug.exceptions import HTTPException
+
+# Set in the environ of every sub-request a batch runs
+BATCH_ENVIRON_KEY = 'api.batch'
+METHODS = {'GET', 'POST', 'DELETE'}
+# The only headers a sub-request may set itself; Authorization is the batch's
+PASSED_HEADERS = {'Idempotency-Key', 'If-None-Match'}
+
+
+class BatchError(ValueError):
+    pass
+
+
+class BatchRunner:
+    """Runs several API calls in-process for one HTTP request.
+
+    Each sub-request is dispatched through the app as a request of its own,
+    under the batch's Authorization header and client address, so it is
+    authenticated, validated and rate limited as usual. Runs of consecutive
+    GETs go to a shared pool in parallel; every other call runs alone, in the
+    order given, so later calls see its effects. Calls not started within
+    deadline seconds of the batch are answered with a 503.
+    """
+
+    def __init__(self, app, max_requests=20, max_writes=5, workers=4, deadline=10, forbidden=()):
+        self.app = app
+        self.max_requests = max_requests
+        self.max_writes = max_writes
+        self.deadline = deadline
+        self.forbidden = set(forbidden)
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='batch')
+
+    def parse(self, body):
+        """Returns the validated sub-requests of a batch body, raising BatchError."""
+        items = body.get('requests') if isinstance(body, dict) else None
+        if not isinstance(items, list) or not items:
+            raise BatchError("requests must be a non-empty list")
+        if len(items) > self.max_requests:
+            raise BatchError(f"A batch holds at most {self.max_requests} requests")
+
+        adapter = self.app.url_map.bind('localhost')
+        parsed = []
+        for index, item in enumerate(items):
+            if not isinstance(item, dict):
+                raise BatchError(f"requests[{index}] must be an object")
+            method = item.get('method', 'GET')
+            path = item.get('path')
+            headers = item.get('headers', {})
+            if method not in METHODS:
+                raise BatchError(f"requests[{index}].method must be one of {', '.join(sorted(METHODS))}")
+            if not isinstance(path, str) or not path.startswith('/api/'):
+                raise BatchError(f"requests[{index}].path must be an /api/ path")
+            if not isinstance(headers, dict) or not set(headers) <= PASSED_HEADERS \
+                    or not all(isinstance(value, str) for value in headers.values()):
+                raise BatchError(f"requests[{index}].headers may only set {', '.join(sorted(PASSED_HEADERS))}")
+
+            try:
+                endpoint, _ = adapter.match(urlsplit(path).path, method=method)
+            except HTTPException:
+                # Unknown routes are answered per item, by the dispatch itself
+                endpoint = None
+            if endpoint in self.forbidden:
+                raise BatchError(f"requests[{index}]: {endpoint} cannot be batched")
+            parsed.append({'method': method, 'path': path, 'body': item.get('body'), 'headers': headers})
+
+        if sum(1 for item in parsed if item['method'] != 'GET') > self.max_writes:
+            raise BatchError(f"A batch holds at most {self.max_writes} writes")
+        return parsed
+
+    def run(self, items, authorization, remote_addr):
+        """Returns a {status, body} result for each sub-request, in order."""
+        deadline = time.monotonic() + self.deadline
+        results = [None] * len(items)
+
+        def call(index):
+            results[index] = self.call(items[index], authorization, remote_addr, deadline)
+
+        reads = []
+        for index, item in enumerate(items):
+            if item['method'] == 'GET':
+                reads.append(index)
+                continue
+            self.run_parallel(reads, call)
+            reads = []
+            call(index)
+        self.run_parallel(reads, call)
+        return results
+
+    def run_parallel(self, indexes, call):
+        if len(indexes) == 1:
+            call(indexes[0])
+            return
+        for future in [self.pool.submit(call, index) for index in indexes]:
+            future.result()
+
+    def call(self, item, authorization, remote_addr, deadline):
+        if time.monotonic() >= deadline:
+            return {'status': 503, 'body': {'msg': "Batch time budget exhausted before this request ran"}}
+
+        headers = dict(item['headers'])
+        if authorization:
+            headers['Authorization'] = authorization
+        # A fresh app context gives the sub-request its own g; reusing the
+        # batch's would let its teardown release the batch's admission slot
+        with self.app.app_context(), \
+                self.app.test_request_context(item['path'], method=item['method'], json=item['body'],
+                                              headers=headers,
+                                              environ_base={BATCH_ENVIRON_KEY: True, 'REMOTE_ADDR': remote_addr}):
+            try:
+                response = self.app.full_dispatch_request()
+            except Exception as e:
+                response = self.app.handle_exception(e)
+
+            data = response.get_data(as_text=True)
+            try:
+                body = json.loads(data) if data else None
+            except ValueError:
+                body = data
+            return {'status': response.status_code, 'body': body}
@@ -0,0 +1,139 @@
+import hashlib
+import hmac
+import json
+import os
+import threading
+import time
+from datetime import datetime
+from urllib.parse import parse_qs, urlencode, urlsplit
+
+from bson import ObjectId
+from flask import g, request
+
+from batch import BATCH_ENVIRON_KEY
+from catalog import SORTS
+
+# Masked strings are cut to this length
+MAX_STRING = 256
+# Query values kept as they are, since they pick the plan rather than carry
+# user input: sort names and flags, and the opaque paging and sync tokens
+KEPT_QUERY_VALUES = set(SORTS) | {'true', 'false', 'yes', 'no'}
+TOKEN_PARAMS = {'since', 'after'}
+
+
+def pseudonym(secret, value, prefix='u_'):
+    return prefix + hmac.new(secret, value.encode(), hashlib.sha256).hexdigest()[:16]
+
+
+def is_datetime(value):
+    try:
+        datetime.fromisoformat(value.replace('Z', '+00:00'))
+        return True
+    except ValueError:
+        return False
+
+
+def is_number(value):
+    try:
+        float(value)
+        return True
+    except ValueError:
+        return False
+
+
+def skeleton(value, subject=None, alias=None):
+    """Keeps a value's shape while dropping anything a user typed.
+
+    Numbers, booleans, ids and timestamps are kept as they drive query cost;
+    other strings become x's of the same length. The caller's own username
+    becomes their pseudonym, so bodies still match the replayed JWT.
+    """
+    if isinstance(value, dict):
+        return {key: skeleton(item, subject, alias) for key, item in value.items()}
+    if isinstance(value, list):
+        return [skeleton(item, subject, alias) for item in value]
+    if not isinstance(value, str):
+        return value
+    if subject is not None and value == subject:
+        return alias
+    if ObjectId.is_valid(value) or is_datetime(value):
+        return value
+    return 'x' * min(len(value), MAX_STRING)
+
+
+def query_skeleton(args, subject=None, alias=None):
+    """skeleton for a query string, whose values all arrive as strings: numbers,
+    sort names, flags, comma separated ids and tokens are kept as well."""
+    return {key: [value if key in TOKEN_PARAMS or value.lower() in KEPT_QUERY_VALUES or is_number(value)
+                  or all(ObjectId.is_valid(part) for part in value.split(','))
+                  else skeleton(value, subject, alias)
+                  for value in values]
+            for key, values in args.items()}
+
+
+def batch_skeleton(body, subject=None, alias=None):
+    """skeleton for a batch body: each call keeps its method, path and headers,
+    so the batch still replays, with its query and body reduced as usual."""
+    items = body.get('requests') if isinstance(body, dict) else None
+    if not isinstance(items, list):
+        return skeleton(body, subject, alias)
+    calls = []
+    for item in items:
+        if not isinstance(item, dict) or not isinstance(item.get('path'), str):
+            calls.append(skeleton(item, subject, alias))
+            continue
+        path = urlsplit(item['path'])
+        query = query_skeleton(parse_qs(path.query, keep_blank_values=True), subject, alias)
+        calls.append({**item,
+                      'path': path.path + ('?' + urlencode(query, doseq=True) if query else ''),
+                      'body': skeleton(item.get('body'), subject, alias)})
+    return {**skeleton(body, subject, alias), 'requests': calls}
+
+
+class TrafficCapture:
+    """Appends one sanitized line per request to an NDJSON file, for replay.py.
+
+    Each line holds the route, path, query and body skeletons, pseudonyms
+    (HMACs, stable for a given secret) of the JWT subject and of the client
+    address, the response status and how long the request took.
+    """
+
+    def __init__(self, path, get_subject, secret=None):
+        self.file = open(path, 'a', buffering=1)
+        self.get_subject = get_subject
+        self.secret = secret.encode() if secret else os.urandom(32)
+        self.lock = threading.Lock()
+
+    def start(self):
+        g.capture_started = (time.time(), time.perf_counter())
+
+    def record(self, response):
+        # A batch is recorded once, not once more per sub-request
+        if 'capture_started' not in g or request.endpoint is None or request.environ.get(BATCH_ENVIRON_KEY):
+            return response
+        started_at, started = g.capture_started
+        subject = self.get_subject()
+        alias = pseudonym(self.secret, subject) if subject else None
+
+        line = json.dumps({
+            'ts': round(started_at, 3),
+            'method': request.method,
+            'endpoint': request.endpoint,
+            'route': request.url_rule.rule if request.url_rule else None,
+            'path': request.path,
+            'query': query_skeleton(request.args.to_dict(flat=False), subject, alias),
+            'body': (batch_skeleton if request.endpoint == 'batch_requests' else skeleton)(
+                request.get_json(silent=True), subject, alias),
+            'idempotency_key': 'Idempotency-Key' in request.headers,
+            'subject': alias,
+            'client': pseudonym(self.secret, request.remote_addr or '', prefix='c_'),
+            'status': response.status_code,
+            'duration_ms': round((time.perf_counter() - started) * 1000, 2),
+        })
+        with self.lock:
+            self.file.write(line + '\n')
+        return response
+
+    def close(self):
+        with self.lock:
+            self.file.close()
@@ -0,0 +1,103 @@
+from datetime import datetime, timezone
+
+from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING
+
+FILTER_PARAMS = {'min_price', 'max_price', 'user', 'in_stock', 'created_after', 'sort', 'limit'}
+SORTS = {
+    'price': [('price', ASCENDING), ('_id', ASCENDING)],
+    '-price': [('price', DESCENDING), ('_id', DESCENDING)],
+    'newest': [('_id', DESCENDING)],
+}
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 500
+
+# Indexes backing each supported query shape, keyed by (filters on user, sort
+# field). Created for both products and services.
+CATALOG_INDEXES = {
+    (True, 'price'): [('user', ASCENDING), ('price', ASCENDING), ('_id', ASCENDING)],
+    (True, '_id'): [('user', ASCENDING), ('_id', ASCENDING)],
+    (False, 'price'): [('price', ASCENDING), ('_id', ASCENDING)],
+    (False, '_id'): [('_id', ASCENDING)],
+}
+
+
+class CatalogQueryError(ValueError):
+    pass
+
+
+def is_filtered(args):
+    return any(param in args for param in FILTER_PARAMS)
+
+
+def parse_price(args, name):
+    value = args.get(name)
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        raise CatalogQueryError(f"{name} must be a number")
+
+
+def build_catalog_query(args, has_stock):
+    """Turns catalog query parameters into (filter, sort, hint, limit).
+
+    Every accepted combination is answered from one of CATALOG_INDEXES:
+    equality on user first, then the sort field, with range filters only on
+    fields of that index. Combinations that would need a collection scan
+    raise CatalogQueryError instead.
+    """
+    unknown = set(args) - (FILTER_PARAMS if has_stock else FILTER_PARAMS - {'in_stock'})
+    if unknown:
+        raise CatalogQueryError(f"Unsupported filter: {', '.join(sorted(unknown))}")
+
+    sort_name = args.get('sort', 'newest')
+    if sort_name not in SORTS:
+        raise CatalogQueryError(f"sort must be one of: {', '.join(SORTS)}")
+    sort = SORTS[sort_name]
+
+    query = {}
+    user = args.get('user')
+    if user:
+        query['user'] = user
+
+    min_price = parse_price(args, 'min_price')
+    max_price = parse_price(args, 'max_price')
+    if min_price is not None or max_price is not None:
+        if sort[0][0] != 'price':
+            raise CatalogQueryError("Price filters require sort=price or sort=-price")
+        query['price'] = {}
+        if min_price is not None:
+            query['price']['$gte'] = min_price
+        if max_price is not None:
+            query['price']['$lte'] = max_price
+
+    created_after = args.get('created_after')
+    if created_after:
+        try:
+            created_after = datetime.fromisoformat(created_after.replace('Z', '+00:00'))
+        except ValueError:
+            raise CatalogQueryError("created_after must be an ISO 8601 date")
+        if sort[0][0] == 'price' and not user:
+            # Only the (user, ...) indexes narrow a price sort before the _id range
+            raise CatalogQueryError("created_after requires sort=newest unless filtering by user")
+        if created_after.tzinfo is None:
+            created_after = created_after.replace(tzinfo=timezone.utc)
+        # ObjectIds start with their creation time, so this is a range on _id
+        query['_id'] = {'$gt': ObjectId.from_datetime(created_after)}
+
+    if args.get('in_stock', '').lower() in ('1', 'true', 'yes'):
+        # Checked against each index hit rather than indexed, since sold out
+        # listings are a small share of the catalog
+        query['quantity'] = {'$gt': 0}
+
+    try:
+        limit = int(args.get('limit', DEFAULT_LIMIT))
+    except ValueError:
+        raise CatalogQueryError("limit must be an integer")
+    if not 1 <= limit <= MAX_LIMIT:
+        raise CatalogQueryError(f"limit must be between 1 and {MAX_LIMIT}")
+
+    hint = CATALOG_INDEXES[(bool(user), sort[0][0])]
+    return query, sort, hint, limit
@@ -0,0 +1,134 @@
+import logging
+import queue
+import threading
+import time
+
+from pymongo.errors import OperationFailure, PyMongoError
+
+logger = logging.getLogger(__name__)
+
+# Fields pushed to subscribers for each watched collection
+WATCHED_FIELDS = {
+    'products': ('quantity',),
+    'services': ('available_dates',),
+}
+# Set on tombstones, which subscribers hear about as deletes
+DELETED = 'deleted'
+# The stream can't resume from a token the oplog no longer holds
+CHANGE_STREAM_HISTORY_LOST = 286
+
+
+class Subscription:
+    def __init__(self, keys, max_pending):
+        self.keys = keys
+        self.events = queue.Queue(maxsize=max_pending)
+        self.closed = False
+
+
+class ChangeHub:
+    """Fans out one MongoDB change stream to every subscriber in this process.
+
+    A single cursor watches the collections in WATCHED_FIELDS and is started
+    with the first subscriber. Subscribers register the (collection, id) keys
+    they care about and receive (collection, event) pairs on their own queue;
+    a subscriber that falls too far behind is closed rather than allowed to
+    block the others.
+    """
+
+    def __init__(self, get_db, max_subscribers=500, max_pending=100):
+        self.get_db = get_db
+        self.max_subscribers = max_subscribers
+        self.max_pending = max_pending
+        self.subscriptions = {}
+        self.count = 0
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def subscribe(self, keys):
+        with self.lock:
+            if self.count >= self.max_subscribers:
+                return None
+            subscription = Subscription(keys, self.max_pending)
+            for key in keys:
+                self.subscriptions.setdefault(key, set()).add(subscription)
+            self.count += 1
+
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name='change-hub', daemon=True)
+                self.thread.start()
+            return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            for key in subscription.keys:
+                subscribers = self.subscriptions.get(key)
+                if subscribers is not None:
+                    subscribers.discard(subscription)
+                    if not subscribers:
+                        del self.subscriptions[key]
+            self.count -= 1
+
+    def publish(self, key, event):
+        with self.lock:
+            subscribers = list(self.subscriptions.get(key, ()))
+        for subscription in subscribers:
+            try:
+                subscription.events.put_nowait((key[0], event))
+            except queue.Full:
+                subscription.closed = True
+
+    def close_all(self):
+        with self.lock:
+            subscribers = {subscription for subscribers in self.subscriptions.values() for subscription in subscribers}
+        for subscription in subscribers:
+            subscription.closed = True
+
+    def _run(self):
+        pipeline = [{'$match': {
+            'ns.coll': {'$in': list(WATCHED_FIELDS)},
+            'operationType': {'$in': ['insert', 'update', 'replace', 'delete']},
+        }}]
+        resume_token = None
+        backoff = 1
+
+        while True:
+            try:
+                with self.get_db().watch(pipeline, full_document='updateLookup',
+                                         resume_after=resume_token) as stream:
+                    backoff = 1
+                    for change in stream:
+                        resume_token = stream.resume_token
+                        self._dispatch(change)
+            except OperationFailure as e:
+                if e.code == CHANGE_STREAM_HISTORY_LOST or not e.has_error_label('ResumableChangeStreamError'):
+                    # Start over from now. Subscribers may have missed changes
+                    # in between, so they are closed to reconnect and snapshot
+                    resume_token = None
+                    self.close_all()
+                logger.error(f"Change stream failed, retrying in {backoff}s: {e}")
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 30)
+            except PyMongoError as e:
+                logger.error(f"Change stream failed, retrying in {backoff}s: {e}")
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 30)
+
+    def _dispatch(self, change):
+        collection = change['ns']['coll']
+        document_id = str(change['documentKey']['_id'])
+        fields = WATCHED_FIELDS[collection]
+
+        if change['operationType'] == 'update':
+            updated = change['updateDescription']['updatedFields']
+            if not any(field.split('.')[0] in fields or field == DELETED for field in updated):
+                return
+
+        event = {'id': document_id}
+        document = change.get('fullDocument')
+        if change['operationType'] == 'delete' or document is None or document.get(DELETED):
+            event['deleted'] = True
+        else:
+            for field in fields:
+                event[field] = document.get(field)
+
+        self.publish((collection, document_id), event)
@@ -0,0 +1,103 @@
+import base64
+from datetime import datetime, timedelta
+
+import pymongo
+from bson import ObjectId
+from bson.errors import InvalidId
+
+# Added to every catalog read so deleted listings stay invisible until their
+# tombstone expires
+LIVE = {'deleted': {'$ne': True}}
+# Projected out of every catalog read: the reservation markers a stock take
+# leaves on a product until its hold is saved
+HIDDEN = {'held_by': 0}
+
+SYNC_INDEX = [('updated_at', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)]
+# Sorts after every ObjectId, so a token holding it covers its whole millisecond
+LAST_ID = ObjectId('f' * 24)
+
+
+class SyncTokenError(Exception):
+    status = 400
+
+
+class SyncTokenExpired(SyncTokenError):
+    status = 410
+
+
+def touch(update):
+    """Adds the updated_at and version bump every catalog write carries."""
+    update = dict(update)
+    update['$set'] = {**update.get('$set', {}), 'updated_at': datetime.utcnow()}
+    update['$inc'] = {**update.get('$inc', {}), 'version': 1}
+    return update
+
+
+def created(document):
+    document['updated_at'] = datetime.utcnow()
+    document['version'] = 1
+    return document
+
+
+def tombstone():
+    return touch({'$set': {'deleted': True, 'deleted_at': datetime.utcnow()}})
+
+
+def millis(moment):
+    # BSON datetimes only keep milliseconds
+    return moment.replace(microsecond=moment.microsecond // 1000 * 1000)
+
+
+def encode_token(updated_at, document_id):
+    raw = f"{updated_at.isoformat(timespec='milliseconds')}|{document_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_token(token):
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)).decode()
+        updated_at, document_id = raw.split('|')
+        return datetime.fromisoformat(updated_at), ObjectId(document_id)
+    except (ValueError, UnicodeDecodeError, InvalidId):
+        raise SyncTokenError("Invalid sync token")
+
+
+def changes_since(collection, token, limit, settle, retention):
+    """Returns (documents, next token, has more) for the documents of
+    collection inserted, updated or deleted after token, oldest first.
+
+    Writes newer than settle seconds are left for the next call, so one that
+    took its timestamp earlier but committed later is not skipped. A token
+    older than retention may have missed tombstones that already expired.
+    """
+    now = datetime.utcnow()
+    cutoff = millis(now - timedelta(seconds=settle))
+    query = {'updated_at': {'$lte': cutoff}}
+    if token:
+        since, since_id = decode_token(token)
+        if since < now - timedelta(seconds=retention):
+            raise SyncTokenExpired("Sync token has expired, download the full catalog again")
+        query['updated_at']['$gte'] = since
+        query['$or'] = [{'updated_at': {'$gt': since}}, {'_id': {'$gt': since_id}}]
+
+    documents = list(collection.find(query, HIDDEN).sort(SYNC_INDEX).hint(SYNC_INDEX).limit(limit + 1))
+    has_more = len(documents) > limit
+    documents = documents[:limit]
+
+    if has_more:
+        next_token = encode_token(documents[-1]['updated_at'], documents[-1]['_id'])
+    else:
+        # Everything up to the cutoff has been seen, so skip ahead to it
+        next_token = encode_token(cutoff, LAST_ID)
+    return documents, next_token, has_more
+
+
+def latest_change(collection):
+    """Returns a marker that moves on every insert, update and delete: the
+    latest updated_at, with the _id and version of every document written in
+    that millisecond, so a second write within it still moves the marker."""
+    document = collection.find_one({}, {'updated_at': 1}, sort=[('updated_at', -1), ('_id', -1)])
+    if not document or document.get('updated_at') is None:
+        return document and (None, document['_id'])
+    written = collection.find({'updated_at': document['updated_at']}, {'version': 1}).sort(SYNC_INDEX)
+    return document['updated_at'], [(sibling['_id'], sibling.get('version')) for sibling in written]
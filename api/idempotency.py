@@ -0,0 +1,114 @@
+import hashlib
+import time
+from datetime import datetime, timedelta
+from functools import wraps
+
+from flask import request, jsonify, make_response
+from flask_jwt_extended import get_jwt_identity
+from pymongo.errors import DuplicateKeyError
+
+IN_PROGRESS = 'in_progress'
+COMPLETED = 'completed'
+
+
+class IdempotencyStore:
+    """Records the response to each Idempotency-Key so retries can replay it.
+
+    Records live in a collection with a TTL index on created_at. A record is
+    inserted as in progress before the handler runs; duplicates arriving
+    meanwhile poll it until the original completes rather than re-executing.
+    """
+
+    def __init__(self, get_collection, run=None, wait_timeout=10, poll_interval=0.05, lock_timeout=60):
+        self.get_collection = get_collection
+        self.run = run or (lambda call, retry=True: call())
+        self.wait_timeout = wait_timeout
+        self.poll_interval = poll_interval
+        self.lock_timeout = lock_timeout
+
+    def claim(self, record_id, fingerprint):
+        """Returns (None, True) if the caller should run the handler, or the
+        existing record and False if it should not."""
+        collection = self.get_collection()
+        deadline = time.monotonic() + self.wait_timeout
+
+        while True:
+            try:
+                self.run(lambda: collection.insert_one({
+                    '_id': record_id,
+                    'fingerprint': fingerprint,
+                    'state': IN_PROGRESS,
+                    'created_at': datetime.utcnow(),
+                }), retry=False)
+                return None, True
+            except DuplicateKeyError:
+                record = self.run(lambda: collection.find_one({'_id': record_id}))
+
+            if record is None:
+                # The original failed and released the key, so try again
+                continue
+            if record['fingerprint'] != fingerprint or record['state'] == COMPLETED:
+                return record, False
+
+            if record['created_at'] < datetime.utcnow() - timedelta(seconds=self.lock_timeout):
+                # The original never finished (e.g. its worker died), take it over
+                taken = self.run(lambda: collection.find_one_and_update(
+                    {'_id': record_id, 'state': IN_PROGRESS, 'created_at': record['created_at']},
+                    {'$set': {'created_at': datetime.utcnow()}}), retry=False)
+                if taken:
+                    return None, True
+
+            if time.monotonic() >= deadline:
+                return record, False
+            time.sleep(self.poll_interval)
+
+    def complete(self, record_id, response):
+        self.run(lambda: self.get_collection().update_one({'_id': record_id}, {'$set': {
+            'state': COMPLETED,
+            'status': response.status_code,
+            'mimetype': response.mimetype,
+            'body': response.get_data(),
+        }}))
+
+    def release(self, record_id):
+        self.run(lambda: self.get_collection().delete_one({'_id': record_id, 'state': IN_PROGRESS}))
+
+    def idempotent(self, view):
+        """Makes a JWT-protected write endpoint safe to retry with an Idempotency-Key header."""
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            key = request.headers.get('Idempotency-Key')
+            if not key:
+                return view(*args, **kwargs)
+            if len(key) > 255:
+                return jsonify({"msg": "Idempotency-Key must be at most 255 characters"}), 400
+
+            record_id = f"{get_jwt_identity()}:{request.endpoint}:{key}"
+            fingerprint = hashlib.sha256(
+                request.method.encode() + request.path.encode() + request.get_data()).hexdigest()
+
+            record, claimed = self.claim(record_id, fingerprint)
+            if not claimed:
+                if record['fingerprint'] != fingerprint:
+                    return jsonify({"msg": "Idempotency-Key was already used for a different request"}), 422
+                if record['state'] != COMPLETED:
+                    return jsonify({"msg": "A request with this Idempotency-Key is still in progress"}), 409
+                response = make_response(record['body'], record['status'])
+                response.mimetype = record['mimetype']
+                response.headers['Idempotent-Replayed'] = 'true'
+                return response
+
+            try:
+                response = make_response(view(*args, **kwargs))
+            except Exception:
+                self.release(record_id)
+                raise
+
+            # Server errors are not final, so let the client retry them for real
+            if response.status_code >= 500:
+                self.release(record_id)
+            else:
+                self.complete(record_id, response)
+            return response
+
+        return wrapper
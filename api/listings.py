@@ -0,0 +1,69 @@
+from datetime import datetime
+
+from changes import LIVE
+from rollups import TOTALS
+
+
+def page_of(seller, kind, after, limit):
+    # Each collection is cut to one page on its (user, _id) index before the
+    # two are merged
+    match = {'user': seller, **LIVE}
+    if after is not None:
+        match['_id'] = {'$gt': after}
+    return [
+        {'$match': match},
+        {'$sort': {'_id': 1}},
+        {'$limit': limit},
+        {'$addFields': {'kind': {'$literal': kind}}},
+    ]
+
+
+def upcoming_appointments(local_field, now, name):
+    # Appointments reference their service by ObjectId or by its string, and
+    # hold their timeslot as a datetime or an ISO string
+    return {'$lookup': {
+        'from': 'appointments',
+        'localField': local_field,
+        'foreignField': 'service_id',
+        'pipeline': [
+            {'$match': {'$or': [{'timeslot': {'$gte': now}}, {'timeslot': {'$gte': now.isoformat()}}]}},
+            {'$count': 'count'},
+        ],
+        'as': name,
+    }}
+
+
+def seller_listings(db, seller, after=None, limit=50):
+    """Returns one page of a seller's products and services in _id order, with
+    remaining stock, units sold and upcoming appointments, and whether more
+    pages follow. Runs as a single aggregation."""
+    now = datetime.utcnow()
+    pipeline = page_of(seller, 'product', after, limit + 1) + [
+        {'$unionWith': {'coll': 'services', 'pipeline': page_of(seller, 'service', after, limit + 1)}},
+        {'$sort': {'_id': 1}},
+        {'$limit': limit + 1},
+        {'$lookup': {'from': 'product_stock_shards', 'localField': '_id', 'foreignField': 'product_id',
+                     'as': 'stock_shards'}},
+        {'$lookup': {'from': TOTALS, 'localField': '_id', 'foreignField': '_id', 'as': 'sales'}},
+        {'$addFields': {'id_string': {'$toString': '$_id'}}},
+        upcoming_appointments('_id', now, 'upcoming'),
+        upcoming_appointments('id_string', now, 'upcoming_legacy'),
+        {'$project': {
+            'kind': 1,
+            'description': 1,
+            'price': 1,
+            'available_dates': 1,
+            'remaining': {'$cond': [
+                {'$eq': ['$kind', 'product']},
+                {'$cond': [{'$ifNull': ['$shards', False]}, {'$sum': '$stock_shards.quantity'}, '$quantity']},
+                None]},
+            'sold': {'$ifNull': [{'$first': '$sales.count'}, 0]},
+            'upcoming_appointments': {'$cond': [
+                {'$eq': ['$kind', 'service']},
+                {'$add': [{'$ifNull': [{'$first': '$upcoming.count'}, 0]},
+                          {'$ifNull': [{'$first': '$upcoming_legacy.count'}, 0]}]},
+                None]},
+        }},
+    ]
+    listings = list(db.products.aggregate(pipeline))
+    return listings[:limit], len(listings) > limit
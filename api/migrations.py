@@ -0,0 +1,198 @@
+import logging
+from datetime import datetime, timezone
+
+from bson import ObjectId
+from pymongo import UpdateOne
+
+logger = logging.getLogger(__name__)
+
+MIGRATIONS_COLLECTION = 'schema_migrations'
+
+
+def parse_time(value):
+    """Parses an ISO 8601 string into the naive UTC datetime BSON stores."""
+    parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+class StorageFormat:
+    """How references and timestamps are written.
+
+    During a rollout some instances still query the old string forms, so new
+    writes keep them until every instance reads both (native=False). Once
+    deployed everywhere, switch native on and run the migrations.
+    """
+
+    def __init__(self, native):
+        self.native = native
+
+    def ref(self, value):
+        return ObjectId(value) if self.native else str(value)
+
+    def time(self, value):
+        return parse_time(value) if self.native else value
+
+    def times(self, values):
+        return [self.time(value) for value in values]
+
+
+def match_ref(value):
+    """Matches a reference stored either as an ObjectId or as its string."""
+    return {'$in': [ObjectId(value), str(value)]}
+
+
+def match_time(value):
+    """Matches a timestamp stored either as a datetime or as an ISO string."""
+    return {'$in': [parse_time(value), value]}
+
+
+# Migrated fields of each collection: (references, timestamps)
+API_FORMS = {
+    'purchases': (('product_id',), ()),
+    'appointments': (('service_id',), ('timeslot',)),
+    'services': ((), ('available_dates',)),
+}
+
+
+def to_api(collection, document):
+    """Renders migrated fields the way the API has always returned them:
+    references as id strings and timestamps as ISO strings."""
+    if document is None:
+        return None
+    refs, times = API_FORMS[collection]
+    document = dict(document)
+    for field in refs:
+        if isinstance(document.get(field), ObjectId):
+            document[field] = str(document[field])
+    for field in times:
+        value = document.get(field)
+        if isinstance(value, datetime):
+            document[field] = value.isoformat()
+        elif isinstance(value, list):
+            document[field] = [item.isoformat() if isinstance(item, datetime) else item for item in value]
+    return document
+
+
+def string_to_object_id(value):
+    return ObjectId(value) if isinstance(value, str) and ObjectId.is_valid(value) else None
+
+
+def string_to_datetime(value):
+    try:
+        return parse_time(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def strings_to_datetimes(values):
+    if not isinstance(values, list):
+        return None
+    converted = [string_to_datetime(value) if isinstance(value, str) else value for value in values]
+    return None if None in converted else converted
+
+
+class Migration:
+    """Converts one field of one collection, a batch at a time.
+
+    Only documents still holding the old form match, and each update is
+    conditioned on the old value, so a migration can be stopped and rerun at
+    any point and never overwrites a concurrent write.
+    """
+
+    def __init__(self, version, description, collection, field, old_form, convert):
+        self.version = version
+        self.description = description
+        self.collection = collection
+        self.field = field
+        self.old_form = old_form
+        self.convert = convert
+
+    def changes(self, document):
+        value = self.convert(document[self.field])
+        return None if value is None else {self.field: value}
+
+    def run(self, db, batch_size):
+        state = db[MIGRATIONS_COLLECTION]
+        progress = state.find_one({'_id': self.version}) or {}
+        last_id = progress.get('last_id')
+        converted = progress.get('converted', 0)
+        state.update_one({'_id': self.version}, {
+            '$set': {'description': self.description, 'state': 'running'},
+            '$setOnInsert': {'started_at': datetime.utcnow()},
+        }, upsert=True)
+
+        while True:
+            query = {self.field: self.old_form}
+            if last_id is not None:
+                query['_id'] = {'$gt': last_id}
+            batch = list(db[self.collection].find(query, {self.field: 1}).sort('_id', 1).limit(batch_size))
+            if not batch:
+                break
+
+            updates = []
+            for document in batch:
+                changes = self.changes(document)
+                if changes is None:
+                    logger.warning(f"Migration {self.version}: cannot convert {self.collection} "
+                                   f"{document['_id']} {self.field}={document.get(self.field)!r}")
+                    continue
+                updates.append(UpdateOne({'_id': document['_id'], self.field: document.get(self.field)},
+                                         {'$set': changes}))
+            if updates:
+                converted += db[self.collection].bulk_write(updates, ordered=False).modified_count
+
+            # The checkpoint moves past unconvertible documents too, so a rerun
+            # doesn't rescan them
+            last_id = batch[-1]['_id']
+            state.update_one({'_id': self.version}, {'$set': {'last_id': last_id, 'converted': converted}})
+
+        state.update_one({'_id': self.version}, {'$set': {'state': 'done', 'finished_at': datetime.utcnow()}})
+        return converted
+
+
+class Backfill(Migration):
+    """Sets a field missing from older documents, from the document's _id."""
+
+    def __init__(self, version, description, collection, field, backfill):
+        super().__init__(version, description, collection, field, {'$exists': False}, None)
+        self.backfill = backfill
+
+    def changes(self, document):
+        return self.backfill(document['_id'])
+
+
+def first_version(document_id):
+    # Documents written before versioning count as written when created
+    created_at = document_id.generation_time.astimezone(timezone.utc).replace(tzinfo=None)
+    return {'updated_at': created_at, 'version': 1}
+
+
+MIGRATIONS = [
+    Migration(1, 'purchases.product_id to ObjectId',
+              'purchases', 'product_id', {'$type': 'string'}, string_to_object_id),
+    Migration(2, 'appointments.service_id to ObjectId',
+              'appointments', 'service_id', {'$type': 'string'}, string_to_object_id),
+    Migration(3, 'bookings.appointment_id to ObjectId',
+              'bookings', 'appointment_id', {'$type': 'string'}, string_to_object_id),
+    Migration(4, 'appointments.timeslot to datetime',
+              'appointments', 'timeslot', {'$type': 'string'}, string_to_datetime),
+    Migration(5, 'services.available_dates to datetimes',
+              'services', 'available_dates', {'$elemMatch': {'$type': 'string'}}, strings_to_datetimes),
+    Backfill(6, 'products.updated_at and version', 'products', 'updated_at', first_version),
+    Backfill(7, 'services.updated_at and version', 'services', 'updated_at', first_version),
+]
+
+
+def pending(db):
+    done = {state['_id'] for state in db[MIGRATIONS_COLLECTION].find({'state': 'done'}, {'_id': 1})}
+    return [migration for migration in MIGRATIONS if migration.version not in done]
+
+
+def migrate(db, batch_size=500):
+    """Runs every migration not yet done, in version order, resuming any that
+    was interrupted from its checkpoint."""
+    for migration in pending(db):
+        converted = migration.run(db, batch_size)
+        logger.info(f"Migration {migration.version} ({migration.description}): converted {converted}")
@@ -0,0 +1,149 @@
+import queue
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+from flask import g, has_request_context, request
+from pymongo import monitoring
+from pymongo.errors import PyMongoError
+
+# Commands explain can describe, and where each keeps its filter
+EXPLAINABLE = {
+    'find': lambda command: {'filter': command.get('filter'), 'sort': command.get('sort')},
+    'aggregate': lambda command: {'pipeline': command.get('pipeline')},
+    'count': lambda command: {'query': command.get('query')},
+    'distinct': lambda command: {'key': command.get('key'), 'query': command.get('query')},
+    'findAndModify': lambda command: {'query': command.get('query'), 'sort': command.get('sort')},
+    'update': lambda command: {'q': [update.get('q') for update in command.get('updates', [])]},
+    'delete': lambda command: {'q': [delete.get('q') for delete in command.get('deletes', [])]},
+}
+# Session and routing fields the driver adds, which explain must not be sent
+DRIVER_FIELDS = {'$db', 'lsid', '$clusterTime', 'txnNumber', '$readPreference', 'readConcern',
+                 'writeConcern', 'autocommit', 'startTransaction'}
+
+
+# Explain fields describing the plan rather than the query, kept verbatim.
+# Everything else (parsedQuery, filter, indexBounds, ...) is redacted.
+PLAN_FIELDS = {'stage', 'namespace', 'indexName', 'keyPattern', 'direction', 'isMultiKey', 'multiKeyPaths',
+               'isUnique', 'isSparse', 'isPartial', 'indexVersion', 'planCacheKey', 'queryHash',
+               'indexFilterSet', 'sortPattern', 'limitAmount', 'skipAmount', 'planNodeId'}
+
+
+def redact(value):
+    """Replaces every literal in a query with its type name, keeping its shape."""
+    if isinstance(value, dict):
+        return {key: redact(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [redact(item) for item in value]
+    if value is None:
+        return None
+    return type(value).__name__
+
+
+def redact_plan(value, keep=False):
+    """Redacts an explain plan, keeping only the fields in PLAN_FIELDS as they are."""
+    if isinstance(value, dict):
+        return {key: redact_plan(item, keep or key in PLAN_FIELDS) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [redact_plan(item, keep) for item in value]
+    return value if keep else redact(value)
+
+
+class SlowQueryListener(monitoring.CommandListener):
+    """Records MongoDB commands slower than threshold_ms in a ring buffer.
+
+    Each record carries the Flask endpoint that issued it and the redacted
+    filter shape. Its queryPlanner explain is captured afterwards on a
+    background thread so the request is not held up. Inside a request the
+    time of every command is also added to g.db_time for Server-Timing.
+    """
+
+    def __init__(self, get_client, threshold_ms, capacity=200):
+        self.get_client = get_client
+        self.threshold_ms = threshold_ms
+        self.records = deque(maxlen=capacity)
+        self.started_commands = {}
+        self.explains = queue.Queue(maxsize=capacity)
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def started(self, event):
+        if event.command_name in EXPLAINABLE:
+            route = request.endpoint if has_request_context() else None
+            self.started_commands[(event.connection_id, event.request_id)] = (event.command, route)
+
+    def succeeded(self, event):
+        self._finished(event)
+
+    def failed(self, event):
+        # Error messages can quote the offending values, so only keep the code name
+        self._finished(event, failure=event.failure.get('codeName', 'error'))
+
+    def _finished(self, event, failure=None):
+        duration_ms = event.duration_micros / 1000
+        if has_request_context():
+            g.db_time = g.get('db_time', 0) + duration_ms
+
+        started = self.started_commands.pop((event.connection_id, event.request_id), None)
+        if started is None or duration_ms < self.threshold_ms:
+            return
+
+        command, route = started
+        record = {
+            'time': datetime.utcnow(),
+            'route': route,
+            'command': event.command_name,
+            'collection': command.get(event.command_name),
+            'database': event.database_name,
+            'duration_ms': round(duration_ms, 2),
+            'shape': redact(EXPLAINABLE[event.command_name](command)),
+            'failure': failure,
+            'explain': None,
+        }
+        self.records.append(record)
+
+        try:
+            self.explains.put_nowait((record, event.database_name, command))
+        except queue.Full:
+            return
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._explain_loop, name='slow-query-explain', daemon=True)
+                self.thread.start()
+
+    def _explain_loop(self):
+        while True:
+            record, database, command = self.explains.get()
+            explainable = {key: value for key, value in command.items() if key not in DRIVER_FIELDS}
+            try:
+                explain = self.get_client()[database].command(
+                    {'explain': explainable, 'verbosity': 'queryPlanner'})
+                record['explain'] = redact_plan(explain.get('queryPlanner', explain))
+            except PyMongoError as e:
+                # Server messages can quote the command's values, so only the code name is kept
+                details = getattr(e, 'details', None) or {}
+                record['explain'] = {'error': details.get('codeName', type(e).__name__)}
+
+    def recent(self):
+        return list(self.records)
+
+
+def start_timer():
+    g.request_started = time.perf_counter()
+
+
+def add_server_timing(response):
+    """Splits the request's time into database, serialization and remaining handler time."""
+    if 'request_started' not in g:
+        return response
+    total = (time.perf_counter() - g.request_started) * 1000
+    db = g.get('db_time', 0)
+    serialize = g.get('serialize_time', 0)
+    response.headers['Server-Timing'] = ', '.join([
+        f'db;dur={db:.1f}',
+        f'serialize;dur={serialize:.1f}',
+        f'handler;dur={max(total - db - serialize, 0):.1f}',
+        f'total;dur={total:.1f}',
+    ])
+    return response
@@ -0,0 +1,96 @@
+import threading
+import time
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def consume(self, now, tokens=1):
+        """Take tokens from the bucket, returning (allowed, seconds until allowed)."""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return True, 0
+        return False, (tokens - self.tokens) / self.rate
+
+    def is_idle(self, now):
+        return self.tokens + (now - self.updated) * self.rate >= self.capacity
+
+
+class RateLimiter:
+    """Token buckets keyed by (route, identity), with per-route limits."""
+
+    def __init__(self, limits, default_limit, max_keys=10000):
+        self.limits = limits
+        self.default_limit = default_limit
+        self.max_keys = max_keys
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def limit_for(self, route):
+        return self.limits.get(route, self.default_limit)
+
+    def hit(self, route, identity):
+        limit = self.limit_for(route)
+        if limit is None:
+            return True, 0
+
+        now = time.monotonic()
+        with self.lock:
+            key = (route, identity)
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                if len(self.buckets) >= self.max_keys:
+                    self._prune(now)
+                bucket = self.buckets[key] = TokenBucket(*limit)
+            return bucket.consume(now)
+
+    def _prune(self, now):
+        # Full buckets hold no state worth keeping, so they are the first to go
+        for key in [key for key, bucket in self.buckets.items() if bucket.is_idle(now)]:
+            del self.buckets[key]
+        if len(self.buckets) >= self.max_keys:
+            self.buckets.clear()
+
+
+class AdmissionController:
+    """Caps concurrent requests and sheds the excess instead of letting it queue."""
+
+    def __init__(self, max_in_flight, max_queued, queue_timeout):
+        self.max_in_flight = max_in_flight
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self.queued = 0
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        with self.cond:
+            if self.in_flight < self.max_in_flight:
+                self.in_flight += 1
+                return True
+            if self.queued >= self.max_queued:
+                return False
+
+            self.queued += 1
+            try:
+                deadline = time.monotonic() + self.queue_timeout
+                while self.in_flight >= self.max_in_flight:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return False
+                    self.cond.wait(remaining)
+                self.in_flight += 1
+                return True
+            finally:
+                self.queued -= 1
+
+    def release(self):
+        with self.cond:
+            self.in_flight -= 1
+            self.cond.notify()
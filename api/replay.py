@@ -0,0 +1,195 @@
+"""Replays traffic recorded with CAPTURE_FILE against a local instance, and
+compares the results of two builds.
+
+    python replay.py run capture.ndjson --out baseline.ndjson --speed 1
+    python replay.py run capture.ndjson --out candidate.ndjson --speed 4
+    python replay.py diff baseline.ndjson candidate.ndjson
+
+Runs are only comparable when each starts from the same database, e.g. by
+restoring the same mongodump into the local mongod before every run. Each
+captured client is sent from its own X-Forwarded-For address so per-client
+rate limits apply as they did live: run the instance with TRUSTED_PROXIES=1.
+"""
+import argparse
+import hashlib
+import json
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+# Pseudonymous users are registered with this password before a run
+REPLAY_PASSWORD = 'replay-password'
+# Long-lived streams would only hold replay threads open
+SKIPPED_ENDPOINTS = {'stream_updates'}
+
+
+def send(base_url, method, path, query=None, body=None, headers=None, timeout=30):
+    """Returns (status, latency in ms, body)."""
+    url = base_url + path
+    if query:
+        url += '?' + urllib.parse.urlencode(query, doseq=True)
+    data = json.dumps(body).encode() if body is not None else None
+    request = urllib.request.Request(url, data=data, method=method, headers=dict(headers or {}))
+    if data is not None:
+        request.add_header('Content-Type', 'application/json')
+
+    started = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            status, payload = response.status, response.read()
+    except urllib.error.HTTPError as e:
+        status, payload = e.code, e.read()
+    except (urllib.error.URLError, OSError) as e:
+        status, payload = None, str(e).encode()
+    return status, (time.perf_counter() - started) * 1000, payload
+
+
+def client_address(client):
+    # A stable private address per captured client
+    digest = hashlib.sha256(client.encode()).digest()
+    return f"10.{digest[0]}.{digest[1]}.{digest[2]}"
+
+
+def load(path):
+    with open(path) as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def log_in(base_url, subjects):
+    """Registers every pseudonymous user and returns a token for each."""
+    tokens = {}
+    for subject in sorted(subjects):
+        credentials = {'username': subject, 'password': REPLAY_PASSWORD}
+        headers = {'X-Forwarded-For': client_address(subject)}
+        send(base_url, 'POST', '/api/register', body=credentials, headers=headers)
+        status, _, payload = send(base_url, 'POST', '/api/login', body=credentials, headers=headers)
+        if status != 200:
+            sys.exit(f"Could not log in as {subject}: {status} {payload[:200]!r}")
+        tokens[subject] = json.loads(payload)['access_token']
+    return tokens
+
+
+def run(capture, base_url, out, speed, concurrency):
+    records = sorted((record for record in load(capture) if record['endpoint'] not in SKIPPED_ENDPOINTS),
+                     key=lambda record: record['ts'])
+    if not records:
+        sys.exit("Nothing to replay")
+    tokens = log_in(base_url, {record['subject'] for record in records if record['subject']})
+
+    lock = threading.Lock()
+    results = []
+
+    def replay(index, record, lag_ms):
+        headers = {'X-Forwarded-For': client_address(record['client'])}
+        if record['subject']:
+            headers['Authorization'] = f"Bearer {tokens[record['subject']]}"
+        if record.get('idempotency_key'):
+            headers['Idempotency-Key'] = f'replay-{index}'
+        status, latency, _ = send(base_url, record['method'], record['path'], record['query'],
+                                  record['body'], headers)
+        with lock:
+            results.append({
+                'index': index,
+                'endpoint': record['endpoint'],
+                'method': record['method'],
+                'status': status,
+                'captured_status': record['status'],
+                'latency_ms': round(latency, 2),
+                'lag_ms': round(lag_ms, 2),
+            })
+
+    # Requests go out at their captured offsets divided by speed (0 sends them
+    # back to back); lag_ms records how late each one was sent
+    first = records[0]['ts']
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for index, record in enumerate(records):
+            due = (record['ts'] - first) / speed if speed else 0
+            delay = due - (time.monotonic() - started)
+            if delay > 0:
+                time.sleep(delay)
+            pool.submit(replay, index, record, max(-delay, 0) * 1000)
+
+    results.sort(key=lambda result: result['index'])
+    with open(out, 'w') as file:
+        for result in results:
+            file.write(json.dumps(result) + '\n')
+    elapsed = time.monotonic() - started
+    print(f"Replayed {len(results)} requests in {elapsed:.1f}s, results in {out}")
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))] if values else 0
+
+
+def summarize(results):
+    by_endpoint = defaultdict(list)
+    for result in results:
+        by_endpoint[result['endpoint']].append(result)
+    return {endpoint: {
+        'count': len(items),
+        'p50': percentile([item['latency_ms'] for item in items], 0.5),
+        'p95': percentile([item['latency_ms'] for item in items], 0.95),
+        'p99': percentile([item['latency_ms'] for item in items], 0.99),
+        'errors': sum(1 for item in items if item['status'] is None or item['status'] >= 500),
+    } for endpoint, items in by_endpoint.items()}
+
+
+def change(before, after):
+    if not before:
+        return ''
+    return f"{(after - before) / before * 100:+.0f}%"
+
+
+def diff(baseline_path, candidate_path):
+    baseline, candidate = load(baseline_path), load(candidate_path)
+    before, after = summarize(baseline), summarize(candidate)
+
+    print(f"{'endpoint':<40} {'count':>6} {'p50 ms':>18} {'p95 ms':>18} {'p99 ms':>18} {'5xx':>9}")
+    for endpoint in sorted(set(before) | set(after)):
+        a = before.get(endpoint, {'count': 0, 'p50': 0, 'p95': 0, 'p99': 0, 'errors': 0})
+        b = after.get(endpoint, {'count': 0, 'p50': 0, 'p95': 0, 'p99': 0, 'errors': 0})
+        latencies = [f"{a[key]:.1f}>{b[key]:.1f} {change(a[key], b[key]):>5}" for key in ('p50', 'p95', 'p99')]
+        print(f"{endpoint:<40} {b['count']:>6} {latencies[0]:>18} {latencies[1]:>18} {latencies[2]:>18} "
+              f"{a['errors']:>4}>{b['errors']:<4}")
+
+    # Same capture, same starting data: any status that differs is a behaviour change
+    statuses = {result['index']: result['status'] for result in baseline}
+    changed = [result for result in candidate if statuses.get(result['index']) != result['status']]
+    print(f"\n{len(changed)} of {len(candidate)} requests changed status")
+    for result in changed[:20]:
+        print(f"  #{result['index']} {result['method']} {result['endpoint']}: "
+              f"{statuses.get(result['index'])} -> {result['status']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help='Replay a capture and record the results')
+    run_parser.add_argument('capture')
+    run_parser.add_argument('--base-url', default='http://localhost:4105')
+    run_parser.add_argument('--out', required=True)
+    run_parser.add_argument('--speed', type=float, default=1.0,
+                            help='1 replays in real time, 4 four times faster, 0 as fast as possible')
+    run_parser.add_argument('--concurrency', type=int, default=40)
+
+    diff_parser = commands.add_parser('diff', help='Compare the results of two runs')
+    diff_parser.add_argument('baseline')
+    diff_parser.add_argument('candidate')
+
+    args = parser.parse_args()
+    if args.command == 'run':
+        run(args.capture, args.base_url, args.out, args.speed, args.concurrency)
+    else:
+        diff(args.baseline, args.candidate)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+import random
+import threading
+import time
+
+from pymongo.errors import AutoReconnect, ConnectionFailure, ExecutionTimeout, NetworkTimeout
+
+# Errors that mean the database, not the request, is the problem
+UNAVAILABLE = (ConnectionFailure, ExecutionTimeout)
+# Operations that ran out of time. The database may just be busy with a slow
+# query, so these neither count towards opening the circuit nor are retried
+TIMEOUTS = (ExecutionTimeout, NetworkTimeout)
+
+
+class CircuitOpen(Exception):
+    def __init__(self, retry_after):
+        super().__init__("Database circuit is open")
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """Stops calling the database after failure_threshold consecutive failures.
+
+    While open, calls fail immediately for reset_timeout seconds. After that
+    one trial call is let through: success closes the circuit, failure opens
+    it again.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=10):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self.lock = threading.Lock()
+
+    def before_call(self):
+        with self.lock:
+            if self.opened_at is None:
+                return
+            remaining = self.opened_at + self.reset_timeout - time.monotonic()
+            if remaining > 0 or self.trial_running:
+                raise CircuitOpen(max(remaining, 1))
+            self.trial_running = True
+
+    def succeeded(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def abandoned(self):
+        # The call ended without telling us whether the database is up
+        with self.lock:
+            self.trial_running = False
+
+    def failed(self):
+        with self.lock:
+            self.failures += 1
+            self.trial_running = False
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+    @property
+    def state(self):
+        with self.lock:
+            if self.opened_at is None:
+                return 'closed'
+            return 'half-open' if self.trial_running else 'open'
+
+
+class DatabaseGuard:
+    """Runs database calls through a circuit breaker, with bounded, jittered
+    retries on AutoReconnect for calls safe to repeat. No retry starts after
+    deadline seconds; each attempt is bounded by the client's socket timeout."""
+
+    def __init__(self, breaker, deadline=3.0, max_attempts=3, base_delay=0.05):
+        self.breaker = breaker
+        self.deadline = deadline
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+
+    def call(self, call, retry=True, deadline=None):
+        deadline = deadline or self.deadline
+        expires = time.monotonic() + deadline
+        attempts = self.max_attempts if retry else 1
+
+        for attempt in range(1, attempts + 1):
+            self.breaker.before_call()
+            try:
+                result = call()
+            except TIMEOUTS:
+                self.breaker.abandoned()
+                raise
+            except UNAVAILABLE as e:
+                self.breaker.failed()
+                delay = random.uniform(0, self.base_delay * 2 ** attempt)
+                if (attempt == attempts or not isinstance(e, AutoReconnect)
+                        or time.monotonic() + delay >= expires):
+                    raise
+                time.sleep(delay)
+            except Exception:
+                # The database answered, so it is up even if the call failed
+                self.breaker.succeeded()
+                raise
+            else:
+                self.breaker.succeeded()
+                return result
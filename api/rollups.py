@@ -0,0 +1,267 @@
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+import pymongo
+from bson import ObjectId
+from pymongo.errors import DuplicateKeyError
+
+from archive import iter_archive
+
+# Per listing per day, and per listing over all time
+DAILY = 'sales_rollups'
+TOTALS = 'sales_totals'
+# Holds the fold in progress, if any, and the lease that keeps folds and
+# rebuilds from running at the same time
+STATE = 'sales_rollup_state'
+# Set on each purchase and booking to the id of the fold that counted it. A
+# record is stored without it, whenever it arrives, so the next fold finds it
+FOLD = 'fold'
+
+ROLLUP_INDEXES = {
+    DAILY: [('seller', pymongo.ASCENDING), ('_id.day', pymongo.ASCENDING)],
+    TOTALS: [('seller', pymongo.ASCENDING), ('revenue', pymongo.DESCENDING)],
+}
+
+
+def seller_sales(db, seller, days):
+    """Returns a seller's all-time totals per listing and their daily totals for
+    the last days days, reading only rollup documents."""
+    listings = [{'listing_id': str(total['_id']), 'kind': total['kind'],
+                 'count': total['count'], 'revenue': total['revenue']}
+                for total in db[TOTALS].find({'seller': seller}).sort('revenue', -1)]
+
+    since = (datetime.now() - timedelta(days=days)).strftime('%Y-%m-%d')
+    daily = [{'day': day['_id'], 'count': day['count'], 'revenue': day['revenue']}
+             for day in db[DAILY].aggregate([
+                 {'$match': {'seller': seller, '_id.day': {'$gte': since}}},
+                 {'$group': {'_id': '$_id.day', 'count': {'$sum': '$count'}, 'revenue': {'$sum': '$revenue'}}},
+                 {'$sort': {'_id': 1}},
+             ])]
+    return {'listings': listings, 'daily': daily}
+
+
+def to_object_id(field):
+    return {'$convert': {'input': field, 'to': 'objectId', 'onError': None, 'onNull': None}}
+
+
+def first(field):
+    return {'$arrayElemAt': [field, 0]}
+
+
+# Both pipelines produce one {listing_id, seller, kind, units, price, day} row
+# per sale, looking up the seller and price for records made before they were
+# stored on the record itself
+PURCHASE_ROWS = [
+    {'$addFields': {'listing_id': to_object_id('$product_id')}},
+    {'$lookup': {'from': 'products', 'localField': 'listing_id', 'foreignField': '_id', 'as': 'listing'}},
+    {'$project': {
+        'listing_id': 1,
+        'seller': {'$ifNull': ['$seller', first('$listing.user')]},
+        'kind': {'$literal': 'product'},
+        'units': {'$ifNull': ['$quantity', 1]},
+        'price': {'$ifNull': ['$price', first('$listing.price')]},
+        'day': {'$dateToString': {'format': '%Y-%m-%d', 'date': '$purchase_time'}},
+    }},
+]
+BOOKING_ROWS = [
+    {'$lookup': {'from': 'appointments', 'localField': 'appointment_id', 'foreignField': '_id', 'as': 'appointment'}},
+    {'$addFields': {'listing_id': {'$ifNull': ['$service_id', to_object_id(first('$appointment.service_id'))]}}},
+    {'$lookup': {'from': 'services', 'localField': 'listing_id', 'foreignField': '_id', 'as': 'listing'}},
+    {'$project': {
+        'listing_id': 1,
+        'seller': {'$ifNull': ['$seller', first('$listing.user')]},
+        'kind': {'$literal': 'service'},
+        'units': {'$literal': 1},
+        'price': {'$ifNull': ['$price', first('$listing.price')]},
+        'day': {'$dateToString': {'format': '%Y-%m-%d', 'date': '$booking_time'}},
+    }},
+]
+SOURCES = {'purchases': PURCHASE_ROWS, 'bookings': BOOKING_ROWS}
+
+
+def grouped_by(key):
+    return [
+        {'$match': {'seller': {'$ne': None}, 'listing_id': {'$ne': None}}},
+        {'$group': {
+            '_id': key,
+            'seller': {'$first': '$seller'},
+            'kind': {'$first': '$kind'},
+            'count': {'$sum': '$units'},
+            'revenue': {'$sum': {'$multiply': ['$units', {'$ifNull': ['$price', 0]}]}},
+        }},
+    ]
+
+
+GROUP_DAILY = grouped_by({'listing_id': '$listing_id', 'day': '$day'})
+GROUP_TOTALS = grouped_by('$listing_id')
+
+
+def merge_into(name, fold, once=True):
+    """Adds grouped counts to the rollup documents of name, tagging each with
+    the fold that last added to it. With once, a document that fold already
+    reached is left alone, so a fold retried after a crash counts nothing
+    twice."""
+    added = {'$mergeObjects': ['$$ROOT', {
+        'count': {'$add': ['$count', '$$new.count']},
+        'revenue': {'$add': ['$revenue', '$$new.revenue']},
+        FOLD: fold,
+    }]}
+    if once:
+        added = {'$cond': [{'$eq': ['$' + FOLD, fold]}, '$$ROOT', added]}
+    return [
+        {'$addFields': {FOLD: fold}},
+        {'$merge': {'into': name, 'whenMatched': [{'$replaceWith': added}]}},
+    ]
+
+
+class Lease:
+    """A lock held in the STATE collection until released, or for seconds
+    after it was last acquired; acquiring it again renews it."""
+
+    def __init__(self, db, seconds):
+        self.db = db
+        self.seconds = seconds
+        self.holder = ObjectId()
+
+    def acquire(self):
+        now = datetime.utcnow()
+        try:
+            self.db[STATE].update_one(
+                {'_id': 'lease', '$or': [{'holder': self.holder}, {'expires_at': {'$lte': now}}]},
+                {'$set': {'holder': self.holder, 'expires_at': now + timedelta(seconds=self.seconds)}},
+                upsert=True)
+            return True
+        except DuplicateKeyError:
+            # Someone else holds it, so the upsert tried to insert a second lease
+            return False
+
+    def release(self):
+        self.db[STATE].delete_one({'_id': 'lease', 'holder': self.holder})
+
+
+@contextmanager
+def exclusive(db, seconds):
+    """Waits for the lease and holds it, so neither folds nor rebuilds run
+    until the block is done."""
+    lease = Lease(db, seconds)
+    while not lease.acquire():
+        time.sleep(1)
+    try:
+        yield lease
+    finally:
+        lease.release()
+
+
+def folded(db):
+    """Matches the purchases and bookings already counted in the rollups."""
+    state = db[STATE].find_one({'_id': 'fold'}) or {}
+    return {FOLD: {'$nin': [None, state.get('folding')]}}
+
+
+def tag(db, fold):
+    """Claims every purchase and booking no fold has counted yet for fold."""
+    for name in SOURCES:
+        db[name].update_many({FOLD: None}, {'$set': {FOLD: fold}})
+
+
+def fold_sales(db, lease_seconds=60):
+    """Folds the purchases and bookings no fold has counted yet into the
+    rollups with $merge. Meant to run periodically off the request path.
+    Returns False if a fold or rebuild was already running.
+
+    Records are picked by the fold tag rather than by _id or time, so a
+    record stored late, e.g. by the write-behind buffer, or with a skewed
+    clock, is still counted by the next fold. The fold's id is saved before
+    records are tagged with it, and the tagging finished before any is
+    merged, so a fold interrupted half way is finished over the same records,
+    and merge_into skips the documents it already reached. A database whose
+    rollups were never built from the tags is rebuilt first.
+    """
+    lease = Lease(db, lease_seconds)
+    if not lease.acquire():
+        return False
+    try:
+        state = db[STATE].find_one({'_id': 'fold'})
+        if state is None:
+            _rebuild(db, lease)
+            return True
+
+        fold = state.get('folding')
+        if fold is None or not state.get('tagged'):
+            if fold is None:
+                if not any(db[name].find_one({FOLD: None}, {'_id': 1}) for name in SOURCES):
+                    return True
+                fold = ObjectId()
+                db[STATE].update_one({'_id': 'fold'}, {'$set': {'folding': fold, 'tagged': False}})
+            # Nothing is merged before the tagging is done, so redoing it is safe
+            tag(db, fold)
+            db[STATE].update_one({'_id': 'fold'}, {'$set': {'tagged': True}})
+
+        window = [{'$match': {FOLD: fold}}]
+        for name, rows in SOURCES.items():
+            db[name].aggregate(window + rows + GROUP_DAILY + merge_into(DAILY, fold))
+            db[name].aggregate(window + rows + GROUP_TOTALS + merge_into(TOTALS, fold))
+
+        db[STATE].update_one({'_id': 'fold'}, {'$unset': {'folding': '', 'tagged': ''}})
+        return True
+    finally:
+        lease.release()
+
+
+def rebuild(db, lease_seconds=600):
+    """Recomputes both rollups from all purchases and bookings, archived ones
+    included, waiting for any running fold to finish. Sales recorded while
+    this runs are left to the next fold, so none are lost or counted twice."""
+    with exclusive(db, lease_seconds) as lease:
+        _rebuild(db, lease)
+
+
+def _rebuild(db, lease):
+    # Everything stored so far is claimed by the rebuild, along with the
+    # records of an interrupted fold, which it counts as well
+    fold = ObjectId()
+    tag(db, fold)
+
+    # Staging collections, indexed like the live ones, replace them once full
+    staging = {DAILY: f'{DAILY}_rebuild', TOTALS: f'{TOTALS}_rebuild'}
+    for name, staged in staging.items():
+        db[staged].drop()
+        db[staged].create_index(ROLLUP_INDEXES[name])
+
+    counted = [{'$match': {FOLD: {'$ne': None}}}]
+    for name, rows in SOURCES.items():
+        db[name].aggregate(counted + rows + GROUP_DAILY + merge_into(staging[DAILY], fold, once=False))
+        lease.acquire()
+
+        # Archived records, all counted before they were moved, go through the
+        # same pipeline from a scratch collection
+        scratch = db[f'{name}_rebuild_archive']
+        scratch.drop()
+        for records in iter_archive(db, name):
+            scratch.insert_many(records)
+        scratch.aggregate(rows + GROUP_DAILY + merge_into(staging[DAILY], fold, once=False))
+        scratch.drop()
+        lease.acquire()
+
+    db[staging[DAILY]].aggregate([
+        {'$group': {
+            '_id': '$_id.listing_id',
+            'seller': {'$first': '$seller'},
+            'kind': {'$first': '$kind'},
+            'count': {'$sum': '$count'},
+            'revenue': {'$sum': '$revenue'},
+        }},
+        {'$addFields': {FOLD: fold}},
+        {'$merge': {'into': staging[TOTALS]}},
+    ])
+
+    for name, staged in staging.items():
+        if db[staged].estimated_document_count():
+            db[staged].rename(name, dropTarget=True)
+        else:
+            db[staged].drop()
+            db[name].delete_many({})
+    db[STATE].replace_one({'_id': 'fold'}, {'_id': 'fold'}, upsert=True)
+    # Left by rollups that tracked folds by _id
+    db[STATE].delete_one({'_id': 'watermark'})
@@ -0,0 +1,101 @@
+import gzip
+import hashlib
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Snapshot:
+    def __init__(self, body, marker):
+        self.body = body
+        self.gzipped = gzip.compress(body, compresslevel=6)
+        self.etag = hashlib.sha256(body).hexdigest()[:32]
+        self.marker = marker
+        self.built_at = time.monotonic()
+
+
+class CatalogSnapshot:
+    """Keeps one response body prebuilt, serialized and gzipped in memory.
+
+    build returns the body as bytes. marker returns a value that changes with
+    every write to the data behind it, so a snapshot past its ttl, or marked
+    dirty by invalidate, is only rebuilt when something changed. Once past ttl, or after invalidate, the
+    old snapshot keeps being served while one background thread refreshes it.
+    Only when there is none, or it is older than max_stale, do requests wait,
+    all of them on the same rebuild.
+    """
+
+    def __init__(self, name, build, marker, ttl=5, max_stale=60, wait_timeout=10):
+        self.name = name
+        self.build = build
+        self.marker = marker
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self.wait_timeout = wait_timeout
+        self.snapshot = None
+        self.dirty = False
+        self.refreshing = None
+        self.lock = threading.Lock()
+
+    def get(self):
+        """Returns the current Snapshot, or None if none could be built."""
+        with self.lock:
+            snapshot = self.snapshot
+            if snapshot is not None:
+                age = time.monotonic() - snapshot.built_at
+                if age < self.ttl and not self.dirty:
+                    return snapshot
+                if age < self.max_stale:
+                    self._refresh_in_background()
+                    return snapshot
+
+            leader = self.refreshing is None
+            if leader:
+                self.refreshing = threading.Event()
+            done = self.refreshing
+
+        if leader:
+            self._refresh(raise_errors=True)
+        else:
+            done.wait(self.wait_timeout)
+        with self.lock:
+            return self.snapshot
+
+    def invalidate(self):
+        with self.lock:
+            self.dirty = True
+            if self.snapshot is not None:
+                self._refresh_in_background()
+
+    def _refresh_in_background(self):
+        # Called with the lock held
+        if self.refreshing is None:
+            self.refreshing = threading.Event()
+            threading.Thread(target=self._refresh, name=f'{self.name}-snapshot', daemon=True).start()
+
+    def _refresh(self, raise_errors=False):
+        with self.lock:
+            dirty, self.dirty = self.dirty, False
+            snapshot = self.snapshot
+        try:
+            # Read the marker first: a write landing during the build then
+            # shows up as a changed marker on the next refresh
+            marker = self.marker()
+            if snapshot is not None and marker == snapshot.marker:
+                snapshot.built_at = time.monotonic()
+            else:
+                snapshot = Snapshot(self.build(), marker)
+            with self.lock:
+                self.snapshot = snapshot
+        except Exception as e:
+            with self.lock:
+                self.dirty = self.dirty or dirty
+            logger.error(f"Failed to refresh the {self.name} snapshot: {e}")
+            if raise_errors:
+                raise
+        finally:
+            with self.lock:
+                done, self.refreshing = self.refreshing, None
+            done.set()
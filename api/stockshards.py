@@ -0,0 +1,157 @@
+import random
+import threading
+import time
+
+from pymongo import ReturnDocument
+
+from changes import touch
+
+
+class ShardedStock:
+    """Splits a hot product's quantity across several shard documents.
+
+    Every purchase of a product otherwise updates the same document, so all
+    buyers queue on one lock. Here each purchase decrements one randomly
+    chosen shard that still has stock, and reads sum the shards, caching the
+    total for cache_ttl seconds. The product's own quantity is resynced to the
+    total whenever a shard runs out or stock is returned, so it stays a good
+    approximation for listings and flips to 0 when the product sells out.
+
+    A take made for a hold records the hold's id and units on each shard it
+    took from, in the same update, so untake() can return exactly what the
+    hold took, and nothing if its take never landed.
+    """
+
+    def __init__(self, get_db, cache_ttl=1.0):
+        self.get_db = get_db
+        self.cache_ttl = cache_ttl
+        self.totals = {}
+        self.lock = threading.Lock()
+
+    @property
+    def shards(self):
+        return self.get_db().product_stock_shards
+
+    def enable(self, product_id, shard_count):
+        """Moves a product's quantity into shard_count shards, returning False
+        if the product is missing or already sharded."""
+        product = self.get_db().products.find_one_and_update(
+            {'_id': product_id, 'shards': {'$exists': False}},
+            touch({'$set': {'shards': shard_count}}))
+        if not product:
+            return False
+
+        quantity = max(product.get('quantity', 0), 0)
+        try:
+            self.shards.insert_many([
+                {'product_id': product_id, 'shard': shard,
+                 'quantity': quantity // shard_count + (1 if shard < quantity % shard_count else 0)}
+                for shard in range(shard_count)])
+        except Exception:
+            self.shards.delete_many({'product_id': product_id})
+            self.get_db().products.update_one({'_id': product_id}, touch({'$unset': {'shards': ''}}))
+            raise
+        return True
+
+    def take(self, product_id, shard_count, units, hold=None):
+        """Removes units from the product's shards, returning False if fewer remain."""
+        def taking(amount):
+            update = {'$inc': {'quantity': -amount}}
+            if hold is not None:
+                update['$push'] = {'held_by': {'id': hold, 'units': amount}}
+            return update
+
+        def returning(amount):
+            update = {'$inc': {'quantity': amount}}
+            if hold is not None:
+                update['$pull'] = {'held_by': {'id': hold}}
+            return update
+
+        # Most purchases take one unit from a random shard in one round trip
+        if units == 1:
+            shard = self.shards.find_one_and_update(
+                {'product_id': product_id, 'shard': random.randrange(shard_count), 'quantity': {'$gte': 1}},
+                taking(1), return_document=ReturnDocument.AFTER)
+            if shard:
+                if shard['quantity'] == 0:
+                    self.sync(product_id)
+                return True
+
+        taken = []
+        needed = units
+        emptied = False
+        for _ in range(2):
+            candidates = list(self.shards.find({'product_id': product_id, 'quantity': {'$gt': 0}}))
+            random.shuffle(candidates)
+            for candidate in candidates:
+                amount = min(needed, candidate['quantity'])
+                shard = self.shards.find_one_and_update(
+                    {'_id': candidate['_id'], 'quantity': {'$gte': amount}},
+                    taking(amount), return_document=ReturnDocument.AFTER)
+                if shard:
+                    taken.append((shard['_id'], amount))
+                    needed -= amount
+                    emptied = emptied or shard['quantity'] == 0
+                    if needed == 0:
+                        if emptied:
+                            self.sync(product_id)
+                        return True
+            if not candidates:
+                break
+
+        for shard_id, amount in taken:
+            self.shards.update_one({'_id': shard_id}, returning(amount))
+        return False
+
+    def untake(self, product_id, hold):
+        """Returns whatever a hold took from the product's shards, returning
+        False if it took nothing or that was already returned."""
+        returned = False
+        for shard in self.shards.find({'product_id': product_id, 'held_by.id': hold}, {'held_by': 1}):
+            units = sum(held['units'] for held in shard['held_by'] if held['id'] == hold)
+            result = self.shards.update_one({'_id': shard['_id'], 'held_by.id': hold},
+                                            {'$inc': {'quantity': units}, '$pull': {'held_by': {'id': hold}}})
+            returned = returned or result.modified_count == 1
+        if returned:
+            self.sync(product_id)
+        return returned
+
+    def settle(self, product_id, hold):
+        """Forgets what a hold took, once the hold itself records it."""
+        self.shards.update_many({'product_id': product_id, 'held_by.id': hold}, {'$pull': {'held_by': {'id': hold}}})
+
+    def put(self, product_id, units):
+        # Refill the emptiest shard so stock stays spread out
+        shard = self.shards.find_one({'product_id': product_id}, {'_id': 1}, sort=[('quantity', 1)])
+        if shard:
+            self.shards.update_one({'_id': shard['_id']}, {'$inc': {'quantity': units}})
+            self.sync(product_id)
+
+    def total(self, product_id):
+        now = time.monotonic()
+        with self.lock:
+            cached = self.totals.get(product_id)
+        if cached and cached[1] > now:
+            return cached[0]
+
+        result = list(self.shards.aggregate([
+            {'$match': {'product_id': product_id}},
+            {'$group': {'_id': None, 'quantity': {'$sum': '$quantity'}}},
+        ]))
+        quantity = result[0]['quantity'] if result else 0
+        with self.lock:
+            self.totals[product_id] = (quantity, now + self.cache_ttl)
+        return quantity
+
+    def sync(self, product_id):
+        """Copies the shard total onto the product document."""
+        self.invalidate(product_id)
+        self.get_db().products.update_one({'_id': product_id}, touch({'$set': {'quantity': self.total(product_id)}}))
+
+    def invalidate(self, product_id):
+        with self.lock:
+            self.totals.pop(product_id, None)
+
+    def delete(self, product_id):
+        self.shards.delete_many({'product_id': product_id})
+        self.invalidate(product_id)
@@ -0,0 +1,121 @@
+import logging
+import threading
+import time
+
+from bson import ObjectId
+from pymongo.errors import BulkWriteError, PyMongoError
+
+logger = logging.getLogger(__name__)
+
+DUPLICATE_KEY = 11000
+
+
+class BufferFull(Exception):
+    pass
+
+
+class WriteBehindBuffer:
+    """Buffers inserts and group-commits them with insert_many.
+
+    A background thread flushes once max_batch documents are waiting or
+    flush_interval seconds have passed. Documents get their _id up front so
+    callers can reference them immediately, and stay visible through pending()
+    until their batch is committed, which lets readers merge them into query
+    results. add() blocks for up to put_timeout seconds while the buffer holds
+    max_pending documents, then raises BufferFull.
+    """
+
+    def __init__(self, get_db, max_batch=100, flush_interval=0.2, max_pending=10000, put_timeout=2):
+        self.get_db = get_db
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.put_timeout = put_timeout
+        self.queued = []
+        self.in_flight = []
+        self.closed = False
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+        self.thread.start()
+
+    def add(self, collection, document):
+        document.setdefault('_id', ObjectId())
+        with self.cond:
+            deadline = time.monotonic() + self.put_timeout
+            while len(self.queued) + len(self.in_flight) >= self.max_pending and not self.closed:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise BufferFull()
+                self.cond.wait(remaining)
+            if self.closed:
+                raise BufferFull()
+
+            self.queued.append((collection, document))
+            if len(self.queued) >= self.max_batch:
+                self.cond.notify_all()
+        return document['_id']
+
+    def pending(self, collection, field, value):
+        """Returns the buffered documents of collection whose field equals value."""
+        with self.cond:
+            return [dict(document) for name, document in self.in_flight + self.queued
+                    if name == collection and document.get(field) == value]
+
+    def close(self):
+        """Stops accepting writes and commits everything still buffered."""
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.thread.join()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                deadline = time.monotonic() + self.flush_interval
+                while len(self.queued) < self.max_batch and not self.closed:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+                if not self.queued and self.closed:
+                    return
+                self.in_flight, self.queued = self.queued, []
+
+            self._commit(self.in_flight)
+
+            with self.cond:
+                self.in_flight = []
+                self.cond.notify_all()
+
+    def _commit(self, batch):
+        by_collection = {}
+        for collection, document in batch:
+            by_collection.setdefault(collection, []).append(document)
+
+        for collection, documents in by_collection.items():
+            backoff = 0.1
+            while True:
+                try:
+                    self.get_db()[collection].insert_many(documents, ordered=False)
+                    break
+                except BulkWriteError as e:
+                    # Every document without a write error landed. A duplicate
+                    # key means a retried batch had landed already; any other
+                    # error, e.g. a failed validation, fails the same way on
+                    # every retry, so that document is dropped
+                    failed = set()
+                    for error in e.details['writeErrors']:
+                        failed.add(error['index'])
+                        if error['code'] != DUPLICATE_KEY:
+                            logger.error(f"Write-behind dropped {collection} {documents[error['index']]['_id']}: "
+                                         f"error code {error['code']}")
+                    if not e.details.get('writeConcernErrors'):
+                        break
+                    # The rest were applied but not acknowledged, so they are
+                    # retried, landing as duplicates at worst
+                    documents = [document for index, document in enumerate(documents) if index not in failed]
+                    logger.error(f"Write-behind insert into {collection} failed, retrying: {e}")
+                except PyMongoError as e:
+                    logger.error(f"Write-behind insert into {collection} failed, retrying: {e}")
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 5)
@@ -1,12 +1,15 @@
+import json
 import requests
 import subprocess
 import random
+import tempfile
 import time
 
 API_BASE_URL = "http://localhost:4105"
 
 def run_command(command):
     result = subprocess.run(command, shell=True, capture_output=True, text=True)
+    return result
 
 def start_docker():
     print("Starting Docker container...")
@@ -19,6 +22,14 @@ def stop_docker():
     run_command("docker-compose down")
     print("--------------------------------------------------------")
 
+def restart_docker(**env):
+    # Restarts the stack with extra settings for the web container
+    stop_docker()
+    print(f"Starting Docker container with {env}...")
+    settings = " ".join(f"{key}={value}" for key, value in env.items())
+    run_command(f"{settings} docker-compose up -d")
+    time.sleep(5)
+
 def test_appointments_and_bookings():
     print("Testing Product Search...")
 
@@ -377,7 +388,7 @@ def test_delete_product():
 
     # Attempt to retrieve deleted product
     response = requests.get(f"{API_BASE_URL}/api/products/{product_id}")
-    assert response.status_code == 500, "\033[91mDeleted product still exists.\033[0m"
+    assert response.status_code == 404, "\033[91mDeleted product still exists.\033[0m"
 
     print("Passed: Delete Product test.")
 
@@ -629,7 +640,7 @@ def test_delete_service():
 
     # Verify that the service is deleted
     get_service_response = requests.get(f"{API_BASE_URL}/api/services/{service_id}")
-    assert get_service_response.status_code == 500, "\033[91mService still exists after deletion.\033[0m"
+    assert get_service_response.status_code == 404, "\033[91mService still exists after deletion.\033[0m"
 
     # Verify that the appointment associated with the service is deleted
     get_appointment_response = requests.get(f"{API_BASE_URL}/api/appointments/{service_id}")
@@ -678,6 +689,659 @@ def test_delete_appointment():
 
     print("Passed: Delete Appointment test.")
 
+def test_login_rate_limit():
+    print("Testing Login Rate Limit...")
+
+    # Burst past the login limit with bad credentials
+    statuses = []
+    for _ in range(10):
+        response = requests.post(f"{API_BASE_URL}/api/login", json={"username": "nobody", "password": "wrong"})
+        statuses.append(response.status_code)
+
+    assert 401 in statuses, "\033[91mFailed: Login attempts within the limit should be processed.\033[0m"
+    assert statuses[-1] == 429, "\033[91mFailed: Login attempts past the limit should be rejected.\033[0m"
+    assert 'Retry-After' in response.headers, "\033[91mFailed: Rate limited response should include Retry-After.\033[0m"
+    print("Passed: Login rate limit test.")
+
+
+def test_idempotent_purchase():
+    print("Testing Idempotent Purchase...")
+
+    # Register a seller and create a product
+    requests.post(f"{API_BASE_URL}/api/register", json={"username": "testuser", "password": "password"})
+    response = requests.post(f"{API_BASE_URL}/api/login", json={"username": "testuser", "password": "password"})
+    assert response.status_code == 200, "\033[91mFailed to login user.\033[0m"
+    seller_headers = {"Authorization": f"Bearer {response.json().get('access_token')}"}
+
+    product_data = {"user": "testuser", "description": "Retried Product", "price": 10, "quantity": 5}
+    response = requests.post(f"{API_BASE_URL}/api/products", json=product_data, headers=seller_headers)
+    assert response.status_code == 201, "\033[91mFailed to create dummy product.\033[0m"
+    product_id = response.json().get("product_id")
+
+    # Register a buyer
+    requests.post(f"{API_BASE_URL}/api/register", json={"username": "testuser1", "password": "password"})
+    response = requests.post(f"{API_BASE_URL}/api/login", json={"username": "testuser1", "password": "password"})
+    assert response.status_code == 200, "\033[91mFailed to login user.\033[0m"
+    headers = {"Authorization": f"Bearer {response.json().get('access_token')}", "Idempotency-Key": "purchase-1"}
+
+    # Retry the same purchase
+    first = requests.post(f"{API_BASE_URL}/api/purchase_product/{product_id}", headers=headers)
+    second = requests.post(f"{API_BASE_URL}/api/purchase_product/{product_id}", headers=headers)
+    assert first.status_code == 200, "\033[91mFailed: Purchase of product.\033[0m"
+    assert second.status_code == 200, "\033[91mFailed: Replayed purchase status.\033[0m"
+    assert second.headers.get("Idempotent-Replayed") == "true", "\033[91mFailed: Retry was not replayed.\033[0m"
+
+    response = requests.get(f"{API_BASE_URL}/api/products/{product_id}")
+    assert response.json()["quantity"] == 4, "\033[91mFailed: Retry purchased the product twice.\033[0m"
+    print("Passed: Idempotent purchase test.")
+
+
+def test_stream_updates():
+    print("Testing Stream Updates Endpoint...")
+
+    requests.post(f"{API_BASE_URL}/api/register", json={"username": "testuser", "password": "password"})
+    response = requests.post(f"{API_BASE_URL}/api/login", json={"username": "testuser", "password": "password"})
+    assert response.status_code == 200, "\033[91mFailed to login user.\033[0m"
+    headers = {"Authorization": f"Bearer {response.json().get('access_token')}"}
+
+    product_data = {"user": "testuser", "description": "Streamed Product", "price": 10, "quantity": 3}
+    response = requests.post(f"{API_BASE_URL}/api/products", json=product_data, headers=headers)
+    assert response.status_code == 201, "\033[91mFailed to create dummy product.\033[0m"
+    product_id = response.json().get("product_id")
+
+    # The stream opens with the current quantity of each subscribed product
+    response = requests.get(f"{API_BASE_URL}/api/stream?products={product_id}", stream=True, timeout=10)
+    assert response.status_code == 200, "\033[91mFailed: Stream status code check.\033[0m"
+    assert response.headers["Content-Type"].startswith("text/event-stream"), "\033[91mFailed: Stream content type check.\033[0m"
+    lines = response.iter_lines(decode_unicode=True)
+    assert next(lines) == "event: product", "\033[91mFailed: Stream snapshot event check.\033[0m"
+    assert '"quantity": 3' in next(lines), "\033[91mFailed: Stream snapshot quantity check.\033[0m"
+
+    # Deleting the product is pushed to the open stream, once its change
+    # stream has had a moment to start
+    time.sleep(1)
+    deleted = requests.delete(f"{API_BASE_URL}/api/products/{product_id}", headers=headers)
+    assert deleted.status_code == 200, "\033[91mFailed to delete streamed product.\033[0m"
+    event = next(line for line in lines if line.startswith("data:"))
+    assert '"deleted": true' in event, "\033[91mFailed: Stream delete event check.\033[0m"
+    response.close()
+
+    response = requests.get(f"{API_BASE_URL}/api/stream")
+    assert response.status_code == 400, "\033[91mFailed: Stream without subscriptions test.\033[0m"
+    print("Passed: Stream updates test.")
+
+
+def test_reservations():
+    print("Testing Reservations...")
+
+    requests.post(f"{API_BASE_URL}/api/register", json={"username": "testuser", "password": "password"})
+    response = requests.post(f"{API_BASE_URL}/api/login", json={"username": "testuser", "password": "password"})
+    assert response.status_code == 200, "\033[91mFailed to login user.\033[0m"
+    seller_headers = {"Authorization": f"Bearer {response.json().get('access_token')}"}
+
+    product_data = {"user": "testuser", "description": "Reserved Product", "price": 10, "quantity": 3}
+    response = requests.post(f"{API_BASE_URL}/api/products", json=product_data, headers=seller_headers)
+    assert response.status_code == 201, "\033[91mFailed to create dummy product.\033[0m"
+    product_id = response.json().get("product_id")
+
+    requests.post(f"{API_BASE_URL}/api/register", json={"username": "testuser1", "password": "password"})
+    response = requests.post(f"{API_BASE_URL}/api/login", json={"username": "testuser1", "password": "password"})
+    assert response.status_code == 200, "\033[91mFailed to login user.\033[0m"
+    headers = {"Authorization": f"Bearer {response.json().get('access_token')}"}
+
+    # Holding more than is in stock is rejected
+    response = requests.post(f"{API_BASE_URL}/api/products/{product_id}/reservations", json={"quantity": 4}, headers=headers)
+    assert response.status_code == 409, "\033[91mFailed: Over-reservation test.\033[0m"
+
+    # Hold two units and confirm them
+    response = requests.post(f"{API_BASE_URL}/api/products/{product_id}/reservations", json={"quantity": 2}, headers=headers)
+    assert response.status_code == 201, "\033[91mFailed: Reserve product test.\033[0m"
+    reservation_id = response.json()["reservation_id"]
+    response = requests.get(f"{API_BASE_URL}/api/products/{product_id}")
+    assert response.json()["quantity"] == 1, "\033[91mFailed: Reservation did not hold stock.\033[0m"
+
+    response = requests.post(f"{API_BASE_URL}/api/reservations/{reservation_id}/confirm", headers=headers)
+    assert response.status_code == 200, "\033[91mFailed: Confirm reservation test.\033[0m"
+    response = requests.post(f"{API_BASE_URL}/api/reservations/{reservation_id}/confirm", headers=headers)
+    assert response.status_code == 409, "\033[91mFailed: Double confirmation test.\033[0m"
+
+    # Hold the last unit, the default without a body, and release it again
+    response = requests.post(f"{API_BASE_URL}/api/products/{product_id}/reservations", headers=headers)
+    assert response.status_code == 201, "\033[91mFailed: Reserve product test.\033[0m"
+    reservation_id = response.json()["reservation_id"]
+    response = requests.delete(f"{API_BASE_URL}/api/reservations/{reservation_id}", headers=headers)
+    assert response.status_code == 200, "\033[91mFailed: Release reservation test.\033[0m"
+    response = requests.get(f"{API_BASE_URL}/api/products/{product_id}")
+    assert response.json()["quantity"] == 1, "\033[91mFailed: Released stock was not returned.\033[0m"
+    print("Passed: Reservations test.")
+
+
+def test_sharded_stock():
+    print("Testing Sharded Stock...")
+
+    requests.post(f"{API_BASE_URL}/api/register", json={"username": "testuser", "password": "password"})
+    response = requests.post(f"{API_BASE_URL}/api/login", json={"username": "testuser", "password": "password"})
+    assert response.status_code == 200, "\033[91mFailed to login user.\033[0m"
+    seller_headers = {"Authorization": f"Bearer {response.json().get('access_token')}"}
+
+    product_data = {"user": "testuser", "description": "Hot Product", "price": 10, "quantity": 3}
+    response = requests.post(f"{API_BASE_URL}/api/products", json=product_data, headers=seller_headers)
+    assert response.status_code == 201, "\033[91mFailed to create dummy product.\033[0m"
+    product_id = response.json().get("product_id")
+
+    response = requests.post(f"{API_BASE_URL}/api/products/{product_id}/shard_stock", json={"shards": 4}, headers=seller_headers)
+    assert response.status_code == 200, "\033[91mFailed: Shard product stock test.\033[0m"
+    response = requests.post(f"{API_BASE_URL}/api/products/{product_id}/shard_stock", json={"shards": 4}, headers=seller_headers)
+    assert response.status_code == 409, "\033[91mFailed: Shard already sharded stock test.\033[0m"
+
+    requests.post(f"{API_BASE_URL}/api/register", json={"username": "testuser1", "password": "password"})
+    response = requests.post(f"{API_BASE_URL}/api/login", json={"username": "testuser1", "password": "password"})
+    assert response.status_code == 200, "\033[91mFailed to login user.\033[0m"
+    headers = {"Authorization": f"Bearer {response.json().get('access_token')}"}
+
+    # Buy out every unit, even though they are spread unevenly across shards
+    for _ in range(3):
+        response = requests.post(f"{API_BASE_URL}/api/purchase_product/{product_id}", headers=headers)
+        assert response.status_code == 200, "\033[91mFailed: Purchase of sharded product.\033[0m"
+    response = requests.post(f"{API_BASE_URL}/api/purchase_product/{product_id}", headers=headers)
+    assert response.status_code == 409, "\033[91mFailed: Sharded product was oversold.\033[0m"
+
+    response = requests.get(f"{API_BASE_URL}/api/products/{product_id}/is_sold_out")
+    assert response.json()["is_sold_out"] == True, "\033[91mFailed: Sharded product sold out check.\033[0m"
+    print("Passed: Sharded stock test.")
+
+
+def test_filter_products():
+    print("Testing Product Filtering...")
+
+    requests.post(f"{API_BASE_URL}/api/register", json={"username": "testuser", "password": "password"})
+    response = requests.post(f"{API_BASE_URL}/api/login", json={"username": "testuser", "password": "password"})
+    assert response.status_code == 200, "\033[91mFailed to login user.\033[0m"
+    headers = {"Authorization": f"Bearer {response.json().get('access_token')}"}
+
+    for price in [5, 15, 25, 35]:
+        product_data = {"user": "testuser", "description": f"Product {price}", "price": price, "quantity": 1}
+        response = requests.post(f"{API_BASE_URL}/api/products", json=product_data, headers=headers)
+        assert response.status_code == 201, "\033[91mFailed to create dummy product.\033[0m"
+
+    response = requests.get(f"{API_BASE_URL}/api/products?min_price=10&max_price=30&sort=-price")
+    assert response.status_code == 200, "\033[91mFailed: Filter products status code check.\033[0m"
+    prices = [product["price"] for product in response.json()]
+    assert prices == [25, 15], "\033[91mFailed: Filter products by price range.\033[0m"
+
+    response = requests.get(f"{API_BASE_URL}/api/products?user=testuser&sort=newest&limit=1")
+    assert [product["price"] for product in response.json()] == [35], "\033[91mFailed: Newest products by seller.\033[0m"
+
+    # Price filters without a price sort would need a collection scan
+    response = requests.get(f"{API_BASE_URL}/api/products?min_price=10&sort=newest")
+    assert response.status_code == 400, "\033[91mFailed: Unsupported filter combination test.\033[0m"
+
+    # So would a creation date range under a price sort across all sellers
+    response = requests.get(f"{API_BASE_URL}/api/products?created_after=2024-01-01&sort=price")
+    assert response.status_code == 400, "\033[91mFailed: Unsupported created_after combination test.\033[0m"
+    print("Passed: Product filtering test.")
+
+
+def test_request_validation():
+    print("Testing Request Validation...")
+
+    requests.post(f"{API_BASE_URL}/api/register", json={"username": "testuser", "password": "password"})
+    response = requests.post(f"{API_BASE_URL}/api/login", json={"username": "testuser", "password": "password"})
+    assert response.status_code == 200, "\033[91mFailed to login user.\033[0m"
+    headers = {"Authorization": f"Bearer {response.json().get('access_token')}"}
+
+    # Numeric strings are coerced and unknown fields dropped
+    product_data = {"user": "testuser", "description": "Coerced Product", "price": "12.5", "quantity": "2", "blob": {"a": [1, 2, 3]}}
+    response = requests.post(f"{API_BASE_URL}/api/products", json=product_data, headers=headers)
+    assert response.status_code == 201, "\033[91mFailed: Create product with coercible fields.\033[0m"
+    product = requests.get(f"{API_BASE_URL}/api/products/{response.json()['product_id']}").json()
+    assert product["price"] == 12.5 and product["quantity"] == 2, "\033[91mFailed: Product fields were not coerced.\033[0m"
+    assert "blob" not in product, "\033[91mFailed: Unknown product field was stored.\033[0m"
+
+    product_data = {"user": "testuser", "description": "Bad Product", "price": "free", "quantity": 1}
+    response = requests.post(f"{API_BASE_URL}/api/products", json=product_data, headers=headers)
+    assert response.status_code == 400, "\033[91mFailed: Non-numeric price test.\033[0m"
+
+    response = requests.get(f"{API_BASE_URL}/api/products/not-an-id")
+    assert response.status_code == 404, "\033[91mFailed: Malformed product id test.\033[0m"
+    print("Passed: Request validation test.")
+
+
+def test_seller_sales():
+    print("Testing Seller Sales Endpoint...")
+    # Sales reach the rollups on the next fold
+    restart_docker(SALES_ROLLUP_INTERVAL=1)
+
+    requests.post(f"{API_BASE_URL}/api/register", json={"username": "testuser", "password": "password"})
+    response = requests.post(f"{API_BASE_URL}/api/login", json={"username": "testuser", "password": "password"})
+    assert response.status_code == 200, "\033[91mFailed to login user.\033[0m"
+    seller_headers = {"Authorization": f"Bearer {response.json().get('access_token')}"}
+
+    product_data = {"user": "testuser", "description": "Sold Product", "price": 10, "quantity": 5}
+    response = requests.post(f"{API_BASE_URL}/api/products", json=product_data, headers=seller_headers)
+    assert response.status_code == 201, "\033[91mFailed to create dummy product.\033[0m"
+    product_id = response.json().get("product_id")
+
+    requests.post(f"{API_BASE_URL}/api/register", json={"username": "testuser1", "password": "password"})
+    response = requests.post(f"{API_BASE_URL}/api/login", json={"username": "testuser1", "password": "password"})
+    assert response.status_code == 200, "\033[91mFailed to login user.\033[0m"
+    headers = {"Authorization": f"Bearer {response.json().get('access_token')}"}
+
+    for _ in range(2):
+        response = requests.post(f"{API_BASE_URL}/api/purchase_product/{product_id}", headers=headers)
+        assert response.status_code == 200, "\033[91mFailed: Purchase of product.\033[0m"
+
+    for _ in range(20):
+        response = requests.get(f"{API_BASE_URL}/api/user/sales", headers=seller_headers)
+        assert response.status_code == 200, "\033[91mFailed: Seller sales status code check.\033[0m"
+        data = response.json()
+        if data["listings"]:
+            break
+        time.sleep(0.5)
+    assert data["listings"] == [{"listing_id": product_id, "kind": "product", "count": 2, "revenue": 20}], "\033[91mFailed: Seller sales per listing.\033[0m"
+    assert sum(day["count"] for day in data["daily"]) == 2, "\033[91mFailed: Seller sales per day.\033[0m"
+    print("Passed: Seller sales test.")
+
+
+def test_slow_queries_admin_only():
+    print("Testing Slow Queries Endpoint...")
+
+    requests.post(f"{API_BASE_URL}/api/register", json={"username": "testuser", "password": "password"})
+    response = requests.post(f"{API_BASE_URL}/api/login", json={"username": "testuser", "password": "password"})
+    assert response.status_code == 200, "\033[91mFailed to login user.\033[0m"
+    headers = {"Authorization": f"Bearer {response.json().get('access_token')}"}
+
+    response = requests.get(f"{API_BASE_URL}/api/admin/slow_queries", headers=headers)
+    assert response.status_code == 403, "\033[91mFailed: Non-admin access to slow queries.\033[0m"
+    response = requests.get(f"{API_BASE_URL}/api/admin/slow_queries")
+    assert response.status_code == 401, "\033[91mFailed: Anonymous access to slow queries.\033[0m"
+    print("Passed: Slow queries endpoint test.")
+
+
+def test_catalog_changes():
+    print("Testing Catalog Changes Endpoint...")
+
+    requests.post(f"{API_BASE_URL}/api/register", json={"username": "testuser", "password": "password"})
+    response = requests.post(f"{API_BASE_URL}/api/login", json={"username": "testuser", "password": "password"})
+    assert response.status_code == 200, "\033[91mFailed to login user.\033[0m"
+    headers = {"Authorization": f"Bearer {response.json().get('access_token')}"}
+
+    response = requests.get(f"{API_BASE_URL}/api/products/changes")
+    assert response.status_code == 200, "\033[91mFailed: Initial changes status code check.\033[0m"
+    token = response.json()["next"]
+
+    product_data = {"user": "testuser", "description": "Synced Product", "price": 10, "quantity": 5}
+    response = requests.post(f"{API_BASE_URL}/api/products", json=product_data, headers=headers)
+    assert response.status_code == 201, "\033[91mFailed to create dummy product.\033[0m"
+    product_id = response.json().get("product_id")
+    response = requests.delete(f"{API_BASE_URL}/api/products/{product_id}", headers=headers)
+    assert response.status_code == 200, "\033[91mFailed to delete dummy product.\033[0m"
+
+    response = requests.get(f"{API_BASE_URL}/api/products/{product_id}")
+    assert response.status_code == 404, "\033[91mFailed: Deleted product is still readable.\033[0m"
+
+    # Changes are held back for the settle window
+    time.sleep(6)
+    response = requests.get(f"{API_BASE_URL}/api/products/changes", params={"since": token})
+    assert response.status_code == 200, "\033[91mFailed: Changes status code check.\033[0m"
+    changes = response.json()["changes"]
+    assert [change["_id"]["$oid"] for change in changes] == [product_id], "\033[91mFailed: Changes since token.\033[0m"
+    assert changes[0]["deleted"] is True, "\033[91mFailed: Deletion is a tombstone.\033[0m"
+
+    response = requests.get(f"{API_BASE_URL}/api/products/changes", params={"since": "not-a-token"})
+    assert response.status_code == 400, "\033[91mFailed: Invalid sync token check.\033[0m"
+    print("Passed: Catalog changes test.")
+
+
+def test_catalog_snapshot():
+    print("Testing Catalog Snapshot...")
+
+    response = requests.get(f"{API_BASE_URL}/api/products", headers={"Accept-Encoding": "gzip"})
+    assert response.status_code == 200, "\033[91mFailed: Get Products status code check.\033[0m"
+    assert response.headers.get("Content-Encoding") == "gzip", "\033[91mFailed: Catalog is gzipped.\033[0m"
+    etag = response.headers.get("ETag")
+    assert etag, "\033[91mFailed: Catalog has an ETag.\033[0m"
+
+    response = requests.get(f"{API_BASE_URL}/api/products", headers={"If-None-Match": etag})
+    assert response.status_code == 304, "\033[91mFailed: Unchanged catalog is not modified.\033[0m"
+    print("Passed: Catalog snapshot test.")
+
+
+def test_user_listings():
+    print("Testing User Listings Endpoint...")
+
+    requests.post(f"{API_BASE_URL}/api/register", json={"username": "testuser", "password": "password"})
+    response = requests.post(f"{API_BASE_URL}/api/login", json={"username": "testuser", "password": "password"})
+    assert response.status_code == 200, "\033[91mFailed to login user.\033[0m"
+    headers = {"Authorization": f"Bearer {response.json().get('access_token')}"}
+
+    product_data = {"user": "testuser", "description": "Listed Product", "price": 10, "quantity": 5}
+    response = requests.post(f"{API_BASE_URL}/api/products", json=product_data, headers=headers)
+    assert response.status_code == 201, "\033[91mFailed to create dummy product.\033[0m"
+    product_id = response.json().get("product_id")
+    service_data = {"user": "testuser", "description": "Listed Service", "price": 20, "available_dates": ["2099-01-01T10:00:00"]}
+    response = requests.post(f"{API_BASE_URL}/api/services", json=service_data, headers=headers)
+    assert response.status_code == 201, "\033[91mFailed to create dummy service.\033[0m"
+    service_id = response.json().get("service_id")
+
+    requests.post(f"{API_BASE_URL}/api/register", json={"username": "testuser1", "password": "password"})
+    response = requests.post(f"{API_BASE_URL}/api/login", json={"username": "testuser1", "password": "password"})
+    assert response.status_code == 200, "\033[91mFailed to login user.\033[0m"
+    buyer_headers = {"Authorization": f"Bearer {response.json().get('access_token')}"}
+    response = requests.post(f"{API_BASE_URL}/api/purchase_product/{product_id}", headers=buyer_headers)
+    assert response.status_code == 200, "\033[91mFailed: Purchase of product.\033[0m"
+    appointment_data = {"user": "testuser1", "service_id": service_id, "timeslot": "2099-01-01T10:00:00"}
+    response = requests.post(f"{API_BASE_URL}/api/appointments", json=appointment_data, headers=buyer_headers)
+    assert response.status_code == 200, "\033[91mFailed: Booking of appointment.\033[0m"
+
+    response = requests.get(f"{API_BASE_URL}/api/user/listings", params={"limit": 1}, headers=headers)
+    assert response.status_code == 200, "\033[91mFailed: User listings status code check.\033[0m"
+    data = response.json()
+    product = data["listings"][0]
+    assert product["kind"] == "product" and product["remaining"] == 4 and product["sold"] == 1, "\033[91mFailed: Product listing summary.\033[0m"
+
+    response = requests.get(f"{API_BASE_URL}/api/user/listings", params={"after": data["next"]}, headers=headers)
+    data = response.json()
+    service = data["listings"][0]
+    assert service["kind"] == "service" and service["upcoming_appointments"] == 1, "\033[91mFailed: Service listing summary.\033[0m"
+    assert data["next"] is None, "\033[91mFailed: User listings pagination.\033[0m"
+    print("Passed: User listings test.")
+
+
+def test_batch_requests():
+    print("Testing Batch Endpoint...")
+
+    requests.post(f"{API_BASE_URL}/api/register", json={"username": "testuser", "password": "password"})
+    response = requests.post(f"{API_BASE_URL}/api/login", json={"username": "testuser", "password": "password"})
+    assert response.status_code == 200, "\033[91mFailed to login user.\033[0m"
+    headers = {"Authorization": f"Bearer {response.json().get('access_token')}"}
+
+    product_data = {"user": "testuser", "description": "Batched Product", "price": 10, "quantity": 5}
+    response = requests.post(f"{API_BASE_URL}/api/products", json=product_data, headers=headers)
+    assert response.status_code == 201, "\033[91mFailed to create dummy product.\033[0m"
+    product_id = response.json().get("product_id")
+
+    batch = {"requests": [
+        {"method": "GET", "path": f"/api/products/{product_id}"},
+        {"method": "GET", "path": f"/api/products/{product_id}/is_sold_out"},
+        {"method": "GET", "path": "/api/user/purchases"},
+        {"method": "GET", "path": "/api/products/ffffffffffffffffffffffff"},
+    ]}
+    response = requests.post(f"{API_BASE_URL}/api/batch", json=batch, headers=headers)
+    assert response.status_code == 200, "\033[91mFailed: Batch status code check.\033[0m"
+    results = response.json()["responses"]
+    assert [result["status"] for result in results] == [200, 200, 200, 404], "\033[91mFailed: Batch per-item statuses.\033[0m"
+    assert results[1]["body"]["is_sold_out"] is False, "\033[91mFailed: Batch item body.\033[0m"
+
+    response = requests.post(f"{API_BASE_URL}/api/batch", json={"requests": [{"method": "POST", "path": "/api/batch"}]}, headers=headers)
+    assert response.status_code == 400, "\033[91mFailed: Nested batch check.\033[0m"
+    print("Passed: Batch requests test.")
+
+
+def test_slow_queries_redacted():
+    print("Testing Slow Queries Redaction...")
+    restart_docker(SLOW_QUERY_MS=0, ADMIN_USERS="testuser")
+
+    requests.post(f"{API_BASE_URL}/api/register", json={"username": "secretuser", "password": "hunter2secret"})
+    response = requests.post(f"{API_BASE_URL}/api/login", json={"username": "secretuser", "password": "hunter2secret"})
+    assert response.status_code == 200, "\033[91mFailed to login user.\033[0m"
+
+    requests.post(f"{API_BASE_URL}/api/register", json={"username": "testuser", "password": "password"})
+    response = requests.post(f"{API_BASE_URL}/api/login", json={"username": "testuser", "password": "password"})
+    assert response.status_code == 200, "\033[91mFailed to login user.\033[0m"
+    headers = {"Authorization": f"Bearer {response.json().get('access_token')}"}
+
+    # Explains are captured in the background
+    time.sleep(1)
+    response = requests.get(f"{API_BASE_URL}/api/admin/slow_queries", headers=headers)
+    assert response.status_code == 200, "\033[91mFailed: Admin access to slow queries.\033[0m"
+    records = response.json()["slow_queries"]
+    assert any(record["route"] == "login" and record["explain"] for record in records), "\033[91mFailed: Login query was recorded with its plan.\033[0m"
+    assert "secretuser" not in response.text and "hunter2secret" not in response.text, "\033[91mFailed: Slow query records contain query values.\033[0m"
+    print("Passed: Slow queries redaction test.")
+
+
+def test_write_behind_read_your_writes():
+    print("Testing Write-Behind Read Your Writes...")
+    # A long flush interval keeps the records buffered while they are read
+    restart_docker(WRITE_BEHIND="true", WRITE_BEHIND_FLUSH_INTERVAL=5)
+
+    requests.post(f"{API_BASE_URL}/api/register", json={"username": "testuser", "password": "password"})
+    response = requests.post(f"{API_BASE_URL}/api/login", json={"username": "testuser", "password": "password"})
+    assert response.status_code == 200, "\033[91mFailed to login user.\033[0m"
+    seller_headers = {"Authorization": f"Bearer {response.json().get('access_token')}"}
+
+    product_data = {"user": "testuser", "description": "Buffered Product", "price": 10, "quantity": 5}
+    response = requests.post(f"{API_BASE_URL}/api/products", json=product_data, headers=seller_headers)
+    assert response.status_code == 201, "\033[91mFailed to create dummy product.\033[0m"
+    product_id = response.json().get("product_id")
+
+    service_data = {"user": "testuser", "description": "Buffered Service", "price": 20, "available_dates": ["2099-01-01T10:00:00"]}
+    response = requests.post(f"{API_BASE_URL}/api/services", json=service_data, headers=seller_headers)
+    assert response.status_code == 201, "\033[91mFailed to create dummy service.\033[0m"
+    service_id = response.json().get("service_id")
+
+    requests.post(f"{API_BASE_URL}/api/register", json={"username": "testuser1", "password": "password"})
+    response = requests.post(f"{API_BASE_URL}/api/login", json={"username": "testuser1", "password": "password"})
+    assert response.status_code == 200, "\033[91mFailed to login user.\033[0m"
+    headers = {"Authorization": f"Bearer {response.json().get('access_token')}"}
+
+    response = requests.post(f"{API_BASE_URL}/api/purchase_product/{product_id}", headers=headers)
+    assert response.status_code == 200, "\033[91mFailed: Purchase of product.\033[0m"
+    appointment_data = {"user": "testuser1", "service_id": service_id, "timeslot": "2099-01-01T10:00:00"}
+    response = requests.post(f"{API_BASE_URL}/api/appointments", json=appointment_data, headers=headers)
+    assert response.status_code == 200, "\033[91mFailed to book appointment.\033[0m"
+
+    # Read straight away, while still buffered, and again once flushed
+    for _ in range(2):
+        response = requests.get(f"{API_BASE_URL}/api/user/purchases", headers=headers)
+        assert response.status_code == 200, "\033[91mFailed: Get user purchases.\033[0m"
+        purchases = response.json()["user_purchases"]
+        assert [purchase["product_id"] for purchase in purchases] == [product_id], "\033[91mFailed: Buffered purchase read back.\033[0m"
+
+        response = requests.get(f"{API_BASE_URL}/api/user/appointments_and_bookings", headers=headers)
+        assert response.status_code == 200, "\033[91mFailed: Get user bookings.\033[0m"
+        assert len(response.json()["user_bookings"]) == 1, "\033[91mFailed: Buffered booking read back.\033[0m"
+        time.sleep(6)
+    print("Passed: Write-behind read your writes test.")
+
+
+def test_archive_history():
+    print("Testing Archive Command...")
+    # Sales are only archived once folded into the rollups, so fold often
+    restart_docker(SALES_ROLLUP_INTERVAL=1)
+
+    requests.post(f"{API_BASE_URL}/api/register", json={"username": "testuser", "password": "password"})
+    response = requests.post(f"{API_BASE_URL}/api/login", json={"username": "testuser", "password": "password"})
+    assert response.status_code == 200, "\033[91mFailed to login user.\033[0m"
+    seller_headers = {"Authorization": f"Bearer {response.json().get('access_token')}"}
+
+    product_data = {"user": "testuser", "description": "Archived Product", "price": 10, "quantity": 5}
+    response = requests.post(f"{API_BASE_URL}/api/products", json=product_data, headers=seller_headers)
+    assert response.status_code == 201, "\033[91mFailed to create dummy product.\033[0m"
+    product_id = response.json().get("product_id")
+
+    service_data = {"user": "testuser", "description": "Archived Service", "price": 20, "available_dates": ["2024-04-01T09:00:00"]}
+    response = requests.post(f"{API_BASE_URL}/api/services", json=service_data, headers=seller_headers)
+    assert response.status_code == 201, "\033[91mFailed to create dummy service.\033[0m"
+    service_id = response.json().get("service_id")
+
+    requests.post(f"{API_BASE_URL}/api/register", json={"username": "testuser1", "password": "password"})
+    response = requests.post(f"{API_BASE_URL}/api/login", json={"username": "testuser1", "password": "password"})
+    assert response.status_code == 200, "\033[91mFailed to login user.\033[0m"
+    headers = {"Authorization": f"Bearer {response.json().get('access_token')}"}
+
+    response = requests.post(f"{API_BASE_URL}/api/purchase_product/{product_id}", headers=headers)
+    assert response.status_code == 200, "\033[91mFailed: Purchase of product.\033[0m"
+    appointment_data = {"user": "testuser1", "service_id": service_id, "timeslot": "2024-04-01T09:00:00"}
+    response = requests.post(f"{API_BASE_URL}/api/appointments", json=appointment_data, headers=headers)
+    assert response.status_code == 200, "\033[91mFailed to book appointment.\033[0m"
+
+    time.sleep(4)
+    result = run_command("docker-compose exec -T web flask archive --days 0")
+    assert result.returncode == 0, f"\033[91mFailed: Archive command. {result.stderr}\033[0m"
+
+    # Archived history is left out unless asked for
+    response = requests.get(f"{API_BASE_URL}/api/user/purchases", headers=headers)
+    assert response.status_code == 200, "\033[91mFailed: Get user purchases.\033[0m"
+    assert response.json()["user_purchases"] == [], "\033[91mFailed: Archived purchases left out.\033[0m"
+    response = requests.get(f"{API_BASE_URL}/api/user/appointments_and_bookings", headers=headers)
+    assert response.status_code == 200, "\033[91mFailed: Get user bookings.\033[0m"
+    data = response.json()
+    assert data["user_bookings"] == [] and data["user_appointments"] == [], "\033[91mFailed: Archived bookings left out.\033[0m"
+
+    response = requests.get(f"{API_BASE_URL}/api/user/purchases?include_archive=true", headers=headers)
+    assert response.status_code == 200, "\033[91mFailed: Get archived purchases.\033[0m"
+    purchases = response.json()["user_purchases"]
+    assert [purchase["product_id"] for purchase in purchases] == [product_id], "\033[91mFailed: Archived purchases read back.\033[0m"
+    response = requests.get(f"{API_BASE_URL}/api/user/appointments_and_bookings?include_archive=true", headers=headers)
+    assert response.status_code == 200, "\033[91mFailed: Get archived bookings.\033[0m"
+    data = response.json()
+    assert len(data["user_bookings"]) == 1, "\033[91mFailed: Archived bookings read back.\033[0m"
+    assert [appointment["service_id"] for appointment in data["user_appointments"]] == [service_id], "\033[91mFailed: Archived appointments read back.\033[0m"
+
+    # Archived sales still count towards the seller's totals
+    response = requests.get(f"{API_BASE_URL}/api/user/sales", headers=seller_headers)
+    assert response.status_code == 200, "\033[91mFailed: Seller sales status code check.\033[0m"
+    assert sum(listing["count"] for listing in response.json()["listings"]) == 2, "\033[91mFailed: Seller sales after archiving.\033[0m"
+    print("Passed: Archive history test.")
+
+
+def test_migrate_appointments():
+    print("Testing Migrate Command...")
+
+    requests.post(f"{API_BASE_URL}/api/register", json={"username": "testuser", "password": "password"})
+    response = requests.post(f"{API_BASE_URL}/api/login", json={"username": "testuser", "password": "password"})
+    assert response.status_code == 200, "\033[91mFailed to login user.\033[0m"
+    seller_headers = {"Authorization": f"Bearer {response.json().get('access_token')}"}
+
+    timeslots = ["2099-01-01T09:00:00", "2099-01-02T09:00:00", "2099-01-03T09:00:00"]
+    service_data = {"user": "testuser", "description": "Migrated Service", "price": 20, "available_dates": timeslots}
+    response = requests.post(f"{API_BASE_URL}/api/services", json=service_data, headers=seller_headers)
+    assert response.status_code == 201, "\033[91mFailed to create dummy service.\033[0m"
+    service_id = response.json().get("service_id")
+
+    requests.post(f"{API_BASE_URL}/api/register", json={"username": "testuser1", "password": "password"})
+    response = requests.post(f"{API_BASE_URL}/api/login", json={"username": "testuser1", "password": "password"})
+    assert response.status_code == 200, "\033[91mFailed to login user.\033[0m"
+    headers = {"Authorization": f"Bearer {response.json().get('access_token')}"}
+
+    def book(timeslot):
+        appointment_data = {"user": "testuser1", "service_id": service_id, "timeslot": timeslot}
+        return requests.post(f"{API_BASE_URL}/api/appointments", json=appointment_data, headers=headers).status_code
+
+    def check_appointments(booked):
+        response = requests.get(f"{API_BASE_URL}/api/appointments/{service_id}")
+        assert response.status_code == 200, "\033[91mFailed: Get appointments for service.\033[0m"
+        appointments = response.json()
+        assert sorted(appointment["timeslot"] for appointment in appointments) == booked, "\033[91mFailed: Appointment timeslots read back as strings.\033[0m"
+        assert all(appointment["service_id"] == service_id for appointment in appointments), "\033[91mFailed: Appointment service ids read back as strings.\033[0m"
+        response = requests.get(f"{API_BASE_URL}/api/user/appointments_and_bookings", headers=headers)
+        assert response.status_code == 200, "\033[91mFailed: Get user appointments.\033[0m"
+        assert len(response.json()["user_appointments"]) == len(booked), "\033[91mFailed: User appointments after migration.\033[0m"
+
+    # Stored as strings, then converted in place
+    assert book(timeslots[0]) == 200, "\033[91mFailed to book appointment before migrating.\033[0m"
+    result = run_command("docker-compose exec -T web flask migrate")
+    assert result.returncode == 0, f"\033[91mFailed: Migrate command. {result.stderr}\033[0m"
+
+    # Still writing strings, next to the converted appointment
+    assert book(timeslots[0]) == 409, "\033[91mFailed: Double booking a migrated timeslot.\033[0m"
+    assert book(timeslots[1]) == 200, "\033[91mFailed to book appointment after migrating.\033[0m"
+    check_appointments(timeslots[:2])
+
+    # Writing native types, next to both
+    print("Recreating the web container with NATIVE_TYPES=true...")
+    run_command("NATIVE_TYPES=true docker-compose up -d web")
+    time.sleep(5)
+    assert book(timeslots[1]) == 409, "\033[91mFailed: Double booking a string timeslot with native types.\033[0m"
+    assert book(timeslots[2]) == 200, "\033[91mFailed to book appointment with native types.\033[0m"
+    check_appointments(timeslots)
+    print("Passed: Migrate appointments test.")
+
+
+def test_database_circuit_breaker():
+    print("Testing Database Circuit Breaker...")
+    restart_docker(DB_CIRCUIT_FAILURES=2, DB_CIRCUIT_RESET=30)
+
+    requests.post(f"{API_BASE_URL}/api/register", json={"username": "testuser", "password": "password"})
+    response = requests.post(f"{API_BASE_URL}/api/login", json={"username": "testuser", "password": "password"})
+    assert response.status_code == 200, "\033[91mFailed to login user.\033[0m"
+    headers = {"Authorization": f"Bearer {response.json().get('access_token')}"}
+
+    product_data = {"user": "testuser", "description": "Circuit Product", "price": 10, "quantity": 5}
+    response = requests.post(f"{API_BASE_URL}/api/products", json=product_data, headers=headers)
+    assert response.status_code == 201, "\033[91mFailed to create dummy product.\033[0m"
+    product_id = response.json().get("product_id")
+
+    result = run_command("docker-compose stop mongo")
+    assert result.returncode == 0, f"\033[91mFailed: Stop mongo. {result.stderr}\033[0m"
+
+    # The first calls wait out server selection and open the circuit
+    for _ in range(2):
+        response = requests.get(f"{API_BASE_URL}/api/products/{product_id}")
+        assert response.status_code == 503, "\033[91mFailed: Unavailable database status code check.\033[0m"
+
+    # Past DB_CIRCUIT_FAILURES, calls fail fast without touching the database
+    for _ in range(5):
+        started = time.monotonic()
+        response = requests.get(f"{API_BASE_URL}/api/products/{product_id}")
+        elapsed = time.monotonic() - started
+        assert response.status_code == 503, "\033[91mFailed: Open circuit status code check.\033[0m"
+        assert int(response.headers.get('Retry-After', 0)) >= 1, "\033[91mFailed: Open circuit Retry-After header.\033[0m"
+        assert elapsed < 0.5, f"\033[91mFailed: Open circuit answered in {elapsed:.2f}s.\033[0m"
+    print("Passed: Database circuit breaker test.")
+
+
+def test_capture_and_replay():
+    print("Testing Traffic Capture and Replay...")
+    # Replayed clients are told apart by X-Forwarded-For
+    restart_docker(CAPTURE_FILE="/tmp/capture.ndjson", TRUSTED_PROXIES=1)
+
+    requests.post(f"{API_BASE_URL}/api/register", json={"username": "testuser", "password": "password"})
+    response = requests.post(f"{API_BASE_URL}/api/login", json={"username": "testuser", "password": "password"})
+    assert response.status_code == 200, "\033[91mFailed to login user.\033[0m"
+    headers = {"Authorization": f"Bearer {response.json().get('access_token')}"}
+
+    product_data = {"user": "testuser", "description": "Captured Product", "price": 10, "quantity": 5}
+    response = requests.post(f"{API_BASE_URL}/api/products", json=product_data, headers=headers)
+    assert response.status_code == 201, "\033[91mFailed to create dummy product.\033[0m"
+    product_id = response.json().get("product_id")
+
+    requests.get(f"{API_BASE_URL}/api/products/{product_id}")
+    requests.get(f"{API_BASE_URL}/api/products?min_price=5&user=testuser&sort=price")
+    requests.post(f"{API_BASE_URL}/api/purchase_product/{product_id}", headers=headers)
+    requests.get(f"{API_BASE_URL}/api/user/purchases", headers=headers)
+
+    result = run_command("docker-compose exec -T web cat /tmp/capture.ndjson")
+    assert result.returncode == 0, f"\033[91mFailed: Read capture file. {result.stderr}\033[0m"
+    records = [json.loads(line) for line in result.stdout.splitlines() if line.strip()]
+    assert len(records) >= 7, "\033[91mFailed: Every call captured.\033[0m"
+
+    # Nothing typed by the user survives, but ids and numeric query values do
+    assert '"testuser"' not in result.stdout and ': "password"' not in result.stdout, "\033[91mFailed: Capture holds raw credentials.\033[0m"
+    subjects = {record["subject"] for record in records if record["subject"]}
+    assert len(subjects) == 1 and subjects.pop().startswith("u_"), "\033[91mFailed: Capture subject pseudonymized.\033[0m"
+    assert any(record["path"] == f"/api/products/{product_id}" for record in records), "\033[91mFailed: Capture keeps ids.\033[0m"
+    filtered = next(record for record in records if record["query"].get("min_price"))
+    assert filtered["query"]["min_price"] == ["5"] and filtered["query"]["sort"] == ["price"], "\033[91mFailed: Capture keeps numeric query values.\033[0m"
+
+    # Replayed against the same database, every call answers as it did live
+    with tempfile.TemporaryDirectory() as directory:
+        capture, out = f"{directory}/capture.ndjson", f"{directory}/replay.ndjson"
+        with open(capture, "w") as file:
+            file.write(result.stdout)
+        result = run_command(f"python api/replay.py run {capture} --out {out} --base-url {API_BASE_URL} --speed 0 --concurrency 1")
+        assert result.returncode == 0, f"\033[91mFailed: Replay run. {result.stderr}\033[0m"
+        with open(out) as file:
+            replayed = [json.loads(line) for line in file if line.strip()]
+    assert len(replayed) == len(records), "\033[91mFailed: Every captured call replayed.\033[0m"
+    changed = [(result["endpoint"], result["captured_status"], result["status"])
+               for result in replayed if result["status"] != result["captured_status"]]
+    assert not changed, f"\033[91mFailed: Replayed statuses match. {changed}\033[0m"
+    print("Passed: Capture and replay test.")
+
+
 # Main script
 tests = [   ("Test appointments and bookings", test_appointments_and_bookings),
             ("Test search", test_product_search),
@@ -697,7 +1361,26 @@ tests = [   ("Test appointments and bookings", test_appointments_and_bookings),
             ('Test purchase product', test_purchase_product) ,
             ('Test get product', test_get_product), 
             ("Test get products", test_get_products), 
-            ("Test health Check", test_health_check)
+            ("Test health Check", test_health_check),
+            ("Test capture and replay", test_capture_and_replay),
+            ("Test database circuit breaker", test_database_circuit_breaker),
+            ("Test migrate appointments", test_migrate_appointments),
+            ("Test archive history", test_archive_history),
+            ("Test write-behind read your writes", test_write_behind_read_your_writes),
+            ("Test slow queries redacted", test_slow_queries_redacted),
+            ("Test batch requests", test_batch_requests),
+            ("Test user listings", test_user_listings),
+            ("Test catalog snapshot", test_catalog_snapshot),
+            ("Test catalog changes", test_catalog_changes),
+            ("Test slow queries admin only", test_slow_queries_admin_only),
+            ("Test seller sales", test_seller_sales),
+            ("Test request validation", test_request_validation),
+            ("Test filter products", test_filter_products),
+            ("Test sharded stock", test_sharded_stock),
+            ("Test reservations", test_reservations),
+            ("Test stream updates", test_stream_updates),
+            ("Test idempotent purchase", test_idempotent_purchase),
+            ("Test login rate limit", test_login_rate_limit)
                                                             ]
 results = []
 